@@ -12,5 +12,5 @@ setup(
     url='https://github.com/sepherro/cam_network',
     install_requires=['PyYAML', 'picamera', 'numpy'],
     packages=find_packages(),
-    scripts=['bin/VSNClientCV', 'bin/VSNClientPiCamera'],
+    scripts=['bin/VSNClientCV', 'bin/VSNClientPiCamera', 'bin/VSNSimulate'],
 )
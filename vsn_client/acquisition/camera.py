@@ -1,86 +1,432 @@
+import json
+import os
+import struct
 import time
 import logging
 from abc import ABCMeta, abstractmethod
-from threading import Thread
-from subprocess import check_call, CalledProcessError
+from enum import Enum
+from threading import Condition, Thread
 
 import cv2
+import numpy as np
 
-from vsn_client.common.utility import Config
+from vsn_client.common import metrics
+from vsn_client.common.utility import Config, Frame
+
+# From linux/videodev2.h
+VIDIOC_S_CTRL = 0xC008561C
+V4L2_CID_EXPOSURE_AUTO = 0x009A0901
+V4L2_EXPOSURE_MANUAL = 1
+
+
+def set_v4l2_control(device: str, control_id: int, value: int):
+    # Sets the control directly, instead of spawning v4l2-ctl
+    import fcntl
+    descriptor = os.open(device, os.O_RDWR)
+    try:
+        fcntl.ioctl(descriptor, VIDIOC_S_CTRL,
+                    struct.pack('Ii', control_id, value))
+    finally:
+        os.close(descriptor)
+
+
+class PowerMode(Enum):
+    normal = 'normal'
+    # Below the activation threshold frames are needed once a second or so
+    low = 'low'
 
 
 class VSNCamera(metaclass=ABCMeta):
+    def __init__(self, source: str):
+        self.__source = source
+        self.__sequence = 0
+
+    @property
+    def source(self) -> str:
+        return self.__source
+
+    @property
+    def frames_kept(self) -> int:
+        # Grabbed frames staying intact while newer ones are grabbed, None
+        # for cameras returning a new image every time
+        return None
+
     @abstractmethod
     def grab_image(self, slow_mode=False):
         ...
 
+    def grab_frame(self, slow_mode=False) -> Frame:
+        # Cameras knowing when their frames were captured override this
+        image = self.grab_image(slow_mode)
+        self.__sequence += 1
+        return Frame(image, time.monotonic(), self.__sequence, self.__source)
+
+    def set_power_mode(self, power_mode: PowerMode):
+        # Cameras without anything to reconfigure capture the same way in
+        # both modes
+        pass
+
 
 class VSNCVCamera(VSNCamera):
-    def __init__(self, camera_number: int):
+    def __init__(self, camera_number: int, low_power_frame_rate: float=None):
+        super().__init__('v4l2:/dev/video%d' % camera_number)
         self.__camera = cv2.VideoCapture(camera_number)
-        self.__camera.set(cv2.CAP_PROP_FRAME_WIDTH,
-                          Config['clients']['image_size']['width'])
-        self.__camera.set(cv2.CAP_PROP_FRAME_HEIGHT,
-                          Config['clients']['image_size']['height'])
+        # Frames grabbed, flushed ones included, and when the last one was
+        self.__sequence = 0
+        self.__timestamp = None
+        self.__frame_rate = Config.client_settings().frame_rate
+        self.__low_power_frame_rate = low_power_frame_rate
+        # Frames queued by the driver, older than the one wanted in slow mode
+        self.__stale_frames = 5
+        image_size = Config.client_settings().image_size
+        self.__camera.set(cv2.CAP_PROP_FRAME_WIDTH, image_size.width)
+        self.__camera.set(cv2.CAP_PROP_FRAME_HEIGHT, image_size.height)
+        # Driver buffers to restore after low power, 0 if not reported
+        self.__buffer_size = int(self.__camera.get(cv2.CAP_PROP_BUFFERSIZE))
 
-        # OpenCV support for setting v4l2 controls is broken
+        # OpenCV support for setting v4l2 controls is broken. Web cams call
+        # the control exposure_auto, the RPi camera auto_exposure.
         try:
-            check_call(['v4l2-ctl', '-c', 'exposure_auto=1'])  # Some web cams
-        except CalledProcessError:
-            logging.warning('Device does not provide exposure_auto control')
+            set_v4l2_control('/dev/video%d' % camera_number,
+                             V4L2_CID_EXPOSURE_AUTO, V4L2_EXPOSURE_MANUAL)
+        except OSError as e:
+            logging.warning('Could not switch off auto exposure: %s', e)
 
-        try:
-            check_call(['v4l2-ctl', '-c', 'auto_exposure=1'])  # For RPi camera
-        except CalledProcessError:
-            logging.warning('Device does not provide auto_exposure control')
+    def set_power_mode(self, power_mode: PowerMode):
+        low_power = power_mode == PowerMode.low
+        if self.__low_power_frame_rate is not None:
+            self.__camera.set(cv2.CAP_PROP_FPS,
+                              self.__low_power_frame_rate if low_power
+                              else self.__frame_rate)
+        # With a single driver buffer fewer stale frames are waiting than
+        # the default queue of about five. The buffered ones were captured
+        # right after the previous grab, so one more is grabbed to get a
+        # frame captured after this one started.
+        buffer_size = 1 if low_power else self.__buffer_size
+        if self.__buffer_size > 0 and self.__camera.set(
+                cv2.CAP_PROP_BUFFERSIZE, buffer_size):
+            self.__stale_frames = buffer_size + 1
 
     def grab_image(self, slow_mode=False):
         if slow_mode:
-            # 5 frames buffer workaround
-            for _ in range(0, 5):
+            # Buffer workaround, the first frames were queued long ago
+            for _ in range(0, self.__stale_frames):
                 self.__camera.grab()
+            self.__sequence += self.__stale_frames
         else:
             self.__camera.grab()
+            self.__sequence += 1
+        self.__timestamp = time.monotonic()
 
         return self.__camera.retrieve()[1]
 
+    def grab_frame(self, slow_mode=False) -> Frame:
+        image = self.grab_image(slow_mode)
+        return Frame(image, self.__timestamp, self.__sequence, self.source)
+
 
 class VSNPiCamera(VSNCamera):
-    def __init__(self):
+    # A worker thread captures continuously from the video port into a ring
+    # of preallocated frames. Grabbing hands out the newest one, which is not
+    # written to again during the next buffer_count - 2 grabs, so frames
+    # waiting in the reactor pipeline stay intact as long as there are
+    # enough buffers for its depth.
+    #
+    # calibration_cache is the path of a file keeping the white balance and
+    # exposure found on the first start, reused instead of waiting for the
+    # camera to adjust them again
+    def __init__(self, calibration_cache: str=None,
+                 low_power_frame_rate: float=None, buffer_count: int=6):
         import picamera
-        import picamera.array
 
+        super().__init__('picamera')
         self.__camera = picamera.PiCamera()
 
-        time.sleep(2)  # Let the camera adjust parameters in auto mode
-        awb_gains = self.__camera.awb_gains
+        calibration_cache = os.path.expanduser(calibration_cache) \
+            if calibration_cache is not None else None
+        calibration = self.__load_calibration(calibration_cache)
+        if calibration is None:
+            time.sleep(2)  # Let the camera adjust parameters in auto mode
+            calibration = {
+                'awb_gains': [float(x) for x in self.__camera.awb_gains],
+                'exposure_speed': self.__camera.exposure_speed,
+                'analog_gain': float(self.__camera.analog_gain),
+                'digital_gain': float(self.__camera.digital_gain)
+            }
+            self.__save_calibration(calibration_cache, calibration)
+        else:
+            self.__camera.shutter_speed = calibration['exposure_speed']
+            try:
+                # Only settable since picamera 1.13
+                self.__camera.analog_gain = calibration['analog_gain']
+                self.__camera.digital_gain = calibration['digital_gain']
+            except (AttributeError, picamera.PiCameraError) as e:
+                logging.warning('Could not restore the camera gains: %s', e)
         self.__camera.awb_mode = 'off'
-        self.__camera.awb_gains = awb_gains
+        self.__camera.awb_gains = tuple(calibration['awb_gains'])
         self.__camera.exposure_mode = 'off'
 
-        self.__camera.resolution = (Config['clients']['image_size']['width'],
-                                    Config['clients']['image_size']['height'])
-        self.__camera.framerate = Config.__settings['clients']['frame_rate']
-        self.__stream = picamera.array.PiRGBArray(
-            self.__camera,
-            size=(Config['clients']['image_size']['width'],
-                  Config['clients']['image_size']['height'])
-        )
-        self.__current_capture_thread = None
+        settings = Config.client_settings()
+        self.__camera.resolution = tuple(settings.image_size)
+        self.__camera.framerate = settings.frame_rate
+        self.__frame_rate = settings.frame_rate
+        self.__low_power_frame_rate = low_power_frame_rate
 
-        self.__camera.capture(self.__stream, format='bgr', use_video_port=True)
+        if buffer_count < 3:
+            raise ValueError('At least three frame buffers are needed')
+        # Raw captures are padded to a width multiple of 32 and a height
+        # multiple of 16, the images handed out are views without it
+        width, height = settings.image_size
+        self.__buffers = [
+            np.empty((-(-height // 16) * 16, -(-width // 32) * 32, 3),
+                     dtype=np.uint8)
+            for _ in range(buffer_count)
+        ]
+        self.__images = [buffer[:height, :width] for buffer in self.__buffers]
+        self.__frame_available = Condition()
+        # Buffer index, sequence number and capture time of the newest frame
+        self.__newest_frame = None
+        self.__sequence = 0
+        # Indices of the frames handed out most recently, oldest first
+        self.__handed_out = []
+        self.__handed_out_sequence = 0
+        self.__frame_timestamp = None
+        self.__frame_sequence = None
+        self.__capturing = False
+        self.__capture_thread = None
+        self.__capture_error = None
 
-    def __grab_image(self):
-        self.__stream.truncate(0)
-        self.__camera.capture(self.__stream, format='bgr', use_video_port=True)
+        self.__captured_frames = metrics.registry.counter(
+            'vsn_camera_captured_frames_total', 'Frames captured')
+        self.__dropped_frames = metrics.registry.counter(
+            'vsn_camera_dropped_frames_total',
+            'Frames overwritten by newer ones before being grabbed')
 
-    def grab_image(self, slow_mode=False):
+        self.__start_capture()
+        self.grab_image()
+
+    @staticmethod
+    def __load_calibration(path: str):
+        if path is None:
+            return None
+        try:
+            with open(path) as stream:
+                return json.load(stream)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def __save_calibration(path: str, calibration: dict):
+        if path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary_path = path + '.tmp'
+            with open(temporary_path, 'w') as stream:
+                json.dump(calibration, stream)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            logging.warning('Could not cache the camera calibration: %s', e)
+
+    def __free_buffer(self) -> int:
+        # Neither the newest frame nor one handed out recently, there is
+        # always one left
+        with self.__frame_available:
+            in_use = set(self.__handed_out)
+            if self.__newest_frame is not None:
+                in_use.add(self.__newest_frame[0])
+        return next(index for index in range(len(self.__buffers))
+                    if index not in in_use)
+
+    def __outputs(self):
+        # Generator of the buffers to capture into; each resumes once the
+        # previous capture is complete
+        while self.__capturing:
+            index = self.__free_buffer()
+            yield self.__buffers[index]
+            self.__captured_frames.inc()
+            with self.__frame_available:
+                self.__sequence += 1
+                self.__newest_frame = (index, self.__sequence,
+                                       time.monotonic())
+                self.__frame_available.notify_all()
+
+    def __capture(self):
         try:
-            self.__current_capture_thread.join()
-        except AttributeError:
-            pass
+            self.__camera.capture_sequence(self.__outputs(), format='bgr',
+                                           use_video_port=True)
+        except Exception as e:
+            logging.error('Capturing stopped: %s', e)
+            with self.__frame_available:
+                self.__capture_error = e
+                self.__frame_available.notify_all()
+
+    def __start_capture(self):
+        self.__capture_error = None
+        self.__capturing = True
+        self.__capture_thread = Thread(target=self.__capture, daemon=True)
+        self.__capture_thread.start()
+
+    def __stop_capture(self):
+        self.__capturing = False
+        self.__capture_thread.join()
+
+    @property
+    def frames_kept(self) -> int:
+        return len(self.__buffers) - 2
+
+    @property
+    def frame_timestamp(self) -> float:
+        # time.monotonic() when the last frame handed out was captured
+        return self.__frame_timestamp
+
+    @property
+    def frame_sequence(self) -> int:
+        # Frames captured up to the last one handed out, the gaps between
+        # two grabs are frames never processed
+        return self.__frame_sequence
+
+    def grab_image(self, slow_mode=False):
+        # The newest frame captured after the previous grab. The buffers
+        # are flushed continuously, so slow mode needs nothing more.
+        with self.__frame_available:
+            self.__frame_available.wait_for(
+                lambda: self.__capture_error is not None or (
+                    self.__newest_frame is not None and
+                    self.__newest_frame[1] > self.__handed_out_sequence))
+            if self.__capture_error is not None:
+                raise IOError('The camera stopped capturing: %s' %
+                              self.__capture_error)
+
+            index, self.__frame_sequence, self.__frame_timestamp = \
+                self.__newest_frame
+            if self.__handed_out_sequence:
+                self.__dropped_frames.inc(
+                    self.__frame_sequence - self.__handed_out_sequence - 1)
+            self.__handed_out_sequence = self.__frame_sequence
+            self.__handed_out.append(index)
+            del self.__handed_out[:-self.frames_kept]
+            return self.__images[index]
+
+    def grab_frame(self, slow_mode=False) -> Frame:
+        image = self.grab_image(slow_mode)
+        return Frame(image, self.__frame_timestamp, self.__frame_sequence,
+                     self.source)
+
+    def set_power_mode(self, power_mode: PowerMode):
+        # The sensor keeps running at the frame rate between grabs
+        if self.__low_power_frame_rate is None:
+            return
+        # The frame rate cannot change while the video port is in use
+        self.__stop_capture()
+        self.__camera.framerate = self.__low_power_frame_rate \
+            if power_mode == PowerMode.low else self.__frame_rate
+        self.__start_capture()
+
+
+class VSNVideoFileCamera(VSNCamera):
+    def __init__(self, path: str, loop: bool=True):
+        super().__init__('video:%s' % path)
+        self.__camera = cv2.VideoCapture(path)
+        if not self.__camera.isOpened():
+            raise IOError('Could not open video file %s' % path)
+        self.__loop = loop
+
+    def grab_image(self, slow_mode=False):
+        result, frame = self.__camera.read()
+        if not result and self.__loop:
+            self.__camera.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            result, frame = self.__camera.read()
+        if not result:
+            raise EOFError('End of video file')
+
+        return frame
+
+
+class VSNImageDirectoryCamera(VSNCamera):
+    image_extensions = ('.bmp', '.jpeg', '.jpg', '.png', '.ppm', '.tif',
+                        '.tiff')
+
+    def __init__(self, path: str, loop: bool=True):
+        super().__init__('images:%s' % path)
+        self.__paths = [os.path.join(path, name)
+                        for name in sorted(os.listdir(path))
+                        if name.lower().endswith(self.image_extensions)]
+        if not self.__paths:
+            raise IOError('No images found in %s' % path)
+        self.__loop = loop
+        self.__index = 0
+
+    def grab_image(self, slow_mode=False):
+        if self.__index == len(self.__paths):
+            if not self.__loop:
+                raise EOFError('No more images in directory')
+            self.__index = 0
+
+        path = self.__paths[self.__index]
+        self.__index += 1
+        frame = cv2.imread(path)
+        if frame is None:
+            raise IOError('Could not read image %s' % path)
+        return frame
+
+
+class VSNSyntheticCamera(VSNCamera):
+    def __init__(self, width: int=None, height: int=None,
+                 number_of_blobs: int=3, blob_radius: int=None,
+                 blob_speed: float=4.0, noise: int=4, seed: int=0):
+        super().__init__('synthetic:%d' % seed)
+        image_size = Config.client_settings().image_size
+        self.__width = width or image_size.width
+        self.__height = height or image_size.height
+        self.__blob_radius = blob_radius or max(
+            min(self.__width, self.__height) // 12, 1)
+        self.__random_state = np.random.RandomState(seed)
+
+        # Static textured scene, identical for a given seed
+        gradient = np.linspace(40, 200, self.__width, dtype=np.float32)
+        texture = self.__random_state.randint(
+            -20, 20, (self.__height, self.__width, 3))
+        self.__scene = np.clip(gradient[np.newaxis, :, np.newaxis] + texture,
+                               0, 255).astype(np.uint8)
+
+        size = np.array([self.__width, self.__height], dtype=np.float64)
+        self.__positions = self.__random_state.uniform(
+            0, 1, (number_of_blobs, 2)) * size
+        angles = self.__random_state.uniform(0, 2 * np.pi, number_of_blobs)
+        self.__velocities = blob_speed * np.column_stack((np.cos(angles),
+                                                          np.sin(angles)))
+        self.__colors = [tuple(int(c) for c in color) for color in
+                         self.__random_state.randint(0, 256,
+                                                     (number_of_blobs, 3))]
+
+        # Sensor noise is drawn once and cycled, generating it per frame
+        # would dominate the grab time
+        self.__noise_frames = [
+            self.__random_state.randint(0, noise + 1, self.__scene.shape)
+            .astype(np.uint8) for _ in range(8)
+        ] if noise else []
+        self.__frame_number = 0
+
+    def __move_blobs(self):
+        self.__positions += self.__velocities
+        for axis, limit in enumerate((self.__width, self.__height)):
+            # bounce off the borders
+            outside = (self.__positions[:, axis] < 0) | \
+                      (self.__positions[:, axis] > limit)
+            self.__velocities[outside, axis] *= -1
+            np.clip(self.__positions[:, axis], 0, limit,
+                    out=self.__positions[:, axis])
+
+    def grab_image(self, slow_mode=False):
+        frame = self.__scene.copy()
+        for (x, y), color in zip(self.__positions, self.__colors):
+            cv2.circle(frame, (int(x), int(y)), self.__blob_radius, color, -1)
 
-        self.__current_capture_thread = Thread(target=self.__grab_image)
-        self.__current_capture_thread.start()
-        return self.__stream.array
+        if self.__noise_frames:
+            cv2.add(frame, self.__noise_frames[
+                self.__frame_number % len(self.__noise_frames)], dst=frame)
 
+        self.__frame_number += 1
+        self.__move_blobs()
+        return frame
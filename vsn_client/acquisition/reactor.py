@@ -1,39 +1,171 @@
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 
-import cv2
 import logging
 import socket
 import time
 
-import numpy
-
 from vsn_client import __version__
+from vsn_client.acquisition.camera import PowerMode
+from vsn_client.acquisition.scheduler import VSNDeadlineScheduler, \
+    OverrunPolicy
 from vsn_client.common.packet import DataPacketToServer, ClientPacketRouter, \
     ConfigurationPacketToServer
+from vsn_client.common import metrics
 from vsn_client.common.utility import ImageType, Config
-from vsn_client.connectivity import multicast
+from vsn_client.connectivity import multicast, protocol
 from vsn_client.connectivity.client import VSNClient
 from vsn_client.processing.activity import VSNActivityController
-from vsn_client.processing.image import VSNImageProcessor
+from vsn_client.processing.image import VSNImageProcessor, encode_image
+
+
+SERVER_PORT = 50001
+
+
+def frames_in_flight(pipeline_settings: dict) -> int:
+    # Grabbed frames referenced at the same time: in the pipelined mode the
+    # queued ones, one waiting to be queued and one under detection
+    if not pipeline_settings.get('enabled', False):
+        return 1
+    return pipeline_settings.get('queue_size', 2) + 2
 
 
 class VSNReactor:
-    def __init__(self, camera, standalone_mode=False):
+    event_loop_lag_probe_interval = 0.1
+
+    def __init__(self, camera, standalone_mode=False, free_running=False):
         self.__node_id = None
+        # Replay recorded sources as fast as possible, ignoring sample_time
+        self.__free_running = free_running
         self.__camera = camera
         self.__send_image = False  # Default - do not send the image data
         self.__image_type = ImageType.foreground
 
-        self.__image_processor = VSNImageProcessor(camera.grab_image())
+        background_settings = Config['clients'].get('background') or {}
+        self.__image_processor = VSNImageProcessor(
+            camera.grab_image(),
+            preallocate=True,
+            excluded_regions=Config['clients'].get('excluded_regions'),
+            tile_grid=Config['clients'].get('tile_grid'),
+            detection_scale=Config['clients'].get('detection_scale', 1.0),
+            background_model=background_settings.get('model',
+                                                     'approximate_median'),
+            background_parameters=background_settings.get('parameters'),
+            morphology_kernel_size=background_settings.get(
+                'morphology_kernel_size', 3),
+            stable_update_interval=background_settings.get(
+                'stable_update_interval')
+        )
         self.__activity_controller = None
 
-        self.__update_task = None
         self.__do_regular_update_time = 0
 
         self.__event_loop = asyncio.get_event_loop()
         self.__stopped = False
-        self.__executor = ThreadPoolExecutor()
+        # Grabbing, detection and encoding never run on the event loop, the
+        # pool is sized so that all three can overlap in the pipelined mode
+        self.__executor = ThreadPoolExecutor(
+            max_workers=Config['clients'].get('executor_workers', 3))
+
+        camera_settings = Config['clients'].get('camera') or {}
+        # Reconfigure the camera whenever the regime of the activity
+        # controller flips
+        self.__power_saving = camera_settings.get('power_saving', False)
+        self.__power_mode = PowerMode.normal
+        self.__sample_cpu_time = {
+            True: metrics.registry.histogram(
+                'vsn_sample_cpu_seconds_below_threshold',
+                'CPU time of the process per sample below the threshold'),
+            False: metrics.registry.histogram(
+                'vsn_sample_cpu_seconds_above_threshold',
+                'CPU time of the process per sample above the threshold')
+        }
+        self.__previous_sample_cpu_time = None
+        self.__previous_sample_below_threshold = None
+
+        self.__grab_time = metrics.registry.histogram(
+            'vsn_grab_seconds', 'Time spent grabbing a frame')
+        self.__frame_age = metrics.registry.histogram(
+            'vsn_frame_age_seconds',
+            'Time from the capture of a frame to its data packet')
+        # Server clock minus the local one, for the capture times
+        self.__clock_offset = 0.0
+        self.__detection_time = metrics.registry.histogram(
+            'vsn_detection_seconds',
+            'Time spent computing the percentage of active pixels')
+        self.__encoding_time = metrics.registry.histogram(
+            'vsn_encoding_seconds', 'Time spent encoding the image')
+        self.__sending_time = metrics.registry.histogram(
+            'vsn_sending_seconds', 'Time spent queueing the data packet')
+        self.__update_time = metrics.registry.histogram(
+            'vsn_update_seconds', 'Time spent in a whole sample')
+        self.__images_sent = metrics.registry.counter(
+            'vsn_images_sent_total', 'Images attached to data packets')
+        self.__activation_level = metrics.registry.gauge(
+            'vsn_activation_level', 'Current activation level')
+        self.__sample_time = metrics.registry.gauge(
+            'vsn_sample_time_seconds', 'Current sample time')
+        self.__event_loop_lag = metrics.registry.histogram(
+            'vsn_event_loop_lag_seconds',
+            'Delay of the event loop in waking up a sleeping task')
+
+        self.__image_sender = None
+        streaming_settings = Config['clients'].get('image_streaming') or {}
+        if streaming_settings.get('adaptive', False):
+            from vsn_client.processing.streaming import \
+                VSNAdaptiveImageSender
+            self.__image_sender = VSNAdaptiveImageSender(
+                bandwidth_budget=streaming_settings.get('bandwidth_budget'),
+                min_quality=streaming_settings.get('min_quality', 30),
+                max_quality=streaming_settings.get('max_quality', 90),
+                skip_threshold=streaming_settings.get('skip_threshold', 0.1),
+                keyframe_interval=streaming_settings.get('keyframe_interval',
+                                                         10),
+                keyframe_max_age=streaming_settings.get('keyframe_max_age',
+                                                        60.0),
+                max_regions=streaming_settings.get('max_regions', 4)
+            )
+
+        scheduler_settings = Config['clients'].get('scheduler') or {}
+        self.__scheduler = VSNDeadlineScheduler(
+            OverrunPolicy(scheduler_settings.get('overrun_policy', 'skip')),
+            scheduler_settings.get('align_to_server_clock', False)
+        )
+
+        pipeline_settings = Config['clients'].get('pipeline') or {}
+        self.__pipeline_queue_size = pipeline_settings.get('queue_size', 2)
+        self.__pipeline_drop_policy = pipeline_settings.get('drop_policy',
+                                                            'block')
+        if self.__pipeline_drop_policy not in ('block', 'drop_oldest'):
+            raise ValueError('Unsupported pipeline drop policy: %r' %
+                             self.__pipeline_drop_policy)
+        self.__run_loop = self.__run_pipelined \
+            if pipeline_settings.get('enabled', False) else self.__run
+        if camera.frames_kept is not None and \
+                camera.frames_kept < frames_in_flight(pipeline_settings):
+            raise ValueError(
+                'The camera keeps %d grabbed frames intact, the pipeline '
+                'needs %d' % (camera.frames_kept,
+                              frames_in_flight(pipeline_settings)))
+        self.__dropped_frames = metrics.registry.counter(
+            'vsn_pipeline_dropped_total',
+            'Frames or packets dropped by a lagging pipeline stage')
+        self.__frame_queue_depth = metrics.registry.gauge(
+            'vsn_pipeline_frame_queue_depth',
+            'Frames waiting for the detection stage')
+        self.__packet_queue_depth = metrics.registry.gauge(
+            'vsn_pipeline_packet_queue_depth',
+            'Packets waiting for the encoding and sending stage')
+
+        metrics_settings = Config['clients'].get('metrics') or {}
+        self.__metrics_piggyback_interval = \
+            metrics_settings.get('piggyback_interval')
+        self.__metrics_piggyback_time = time.perf_counter()
+        if metrics_settings.get('http_port') is not None:
+            self.__event_loop.run_until_complete(
+                metrics.start_http_server(
+                    metrics_settings['http_port'],
+                    metrics_settings.get('http_host', '127.0.0.1')))
 
         if standalone_mode:
             self.__client = None
@@ -45,33 +177,67 @@ class VSNReactor:
 
             self.start = self.__start_standalone
         else:
-            self.__client = VSNClient(multicast.Client().receive_ip(),
-                                      50001,
-                                      ClientPacketRouter(
-                                          self.__process_data_packet,
-                                          self.__process_configuration_packet,
-                                          self.__process_disconnect_packet
-                                      ))
-            self.__waiting_for_configuration = False
+            self.__configuration_received = asyncio.Event()
+            self.__configuration_sent = False
+
+            discovery_settings = Config['clients'].get('discovery') or {}
+            self.__discovery = multicast.VSNServerDiscovery(
+                port=discovery_settings.get('port', multicast.DISCOVERY_PORT),
+                group=discovery_settings.get('group'),
+                ipv6=discovery_settings.get('ipv6', False),
+                timeout=discovery_settings.get('timeout', 5),
+                retries=discovery_settings.get('retries', 3),
+                window=discovery_settings.get('window', 0.5),
+                cache_path=discovery_settings.get('cache')
+            )
+
+            connection_settings = Config['clients'].get('connection') or {}
+            reconnect = connection_settings.get('reconnect', True)
+            # The cached address saves waiting for the next announcement, a
+            # stale one is replaced by discovery when reconnecting
+            server_address = self.__discovery.cached_address()
+            if not reconnect and (server_address is None or
+                                  not self.__discovery.is_reachable(
+                                      server_address)):
+                server_address = None
+                while server_address is None:
+                    server_address = self.__discovery.locate()
+
+            self.__datagram_settings = \
+                Config['clients'].get('datagrams') or {}
+            self.__client = VSNClient(
+                server_address,
+                SERVER_PORT,
+                ClientPacketRouter(
+                    self.__process_data_packet,
+                    self.__process_configuration_packet,
+                    self.__process_disconnect_packet
+                ),
+                server_locator=self.__discovery.locate,
+                connection_made_callback=self.__process_connection_made,
+                queue_size=connection_settings.get('queue_size', 16),
+                coalesce=connection_settings.get('coalesce', True),
+                reconnect=reconnect,
+                reconnect_delay=connection_settings.get('reconnect_delay', 1),
+                max_reconnect_delay=connection_settings.get(
+                    'max_reconnect_delay', 30)
+            )
 
             self.start = self.__start
 
     async def __update(self):
         current_time = time.perf_counter()
-        logging.debug('\nPREVIOUS REGULAR UPDATE WAS %.2f ms AGO' %
-                      ((current_time - self.__do_regular_update_time) * 1000))
+        logging.debug('Previous regular update was %.2f ms ago',
+                      (current_time - self.__do_regular_update_time) * 1000)
         self.__do_regular_update_time = current_time
 
-        frame = self.__camera.grab_image(
-            slow_mode=self.__activity_controller.activation_is_below_threshold
-        )
+        frame = await self.__grab_frame()
 
         time_start = time.perf_counter()
 
         percentage_of_active_pixels = await self.__event_loop.run_in_executor(
             self.__executor,
-            self.__image_processor.get_percentage_of_active_pixels_in_frame,
-            frame
+            self.__image_processor.process_frame, frame
         )
 
         self.__activity_controller.update_sensor_state(
@@ -80,53 +246,111 @@ class VSNReactor:
 
         time_after_get_percentage = time.perf_counter()
 
-        if self.__activity_controller.activation_is_below_threshold \
-                and not self.__send_image:
-            image_as_string = None
-        else:
-            image_as_string = self.__encode_image_for_sending()
+        packet = self.__create_data_packet(percentage_of_active_pixels)
+        if self.__image_is_needed():
+            await self.__encode_images(
+                packet, self.__image_processor.get_image(self.__image_type))
 
         time_after_encoding = time.perf_counter()
 
         if self.__client:
-            self.__client.send(
-                DataPacketToServer(percentage_of_active_pixels,
-                                   self.__activity_controller.activation_level,
-                                   self.__activity_controller.gain,
-                                   self.__activity_controller.sample_time,
-                                   image_as_string)
-            )
+            self.__client.send(packet)
 
         time_after_sending_packet = time.perf_counter()
 
-        logging.debug(
-            'Calculating percentage took: %.2f ms' %
-            ((time_after_get_percentage - time_start) * 1000)
-        )
-        logging.debug(
-            'Encoding took: %.2f ms' %
-            ((time_after_encoding - time_after_get_percentage) * 1000)
-        )
-        logging.debug(
-            'Sending packet took: %.2f ms' %
-            ((time_after_sending_packet - time_after_encoding) * 1000)
-        )
-        logging.debug(
-            'Percentage of active pixels: %.2f' % percentage_of_active_pixels
+        self.__grab_time.observe(time_start - current_time)
+        self.__detection_time.observe(time_after_get_percentage - time_start)
+        self.__sending_time.observe(time_after_sending_packet -
+                                    time_after_encoding)
+        self.__activation_level.set(
+            self.__activity_controller.activation_level)
+        self.__sample_time.set(self.__activity_controller.sample_time)
+
+        logging.debug('Percentage of active pixels: %.2f',
+                      percentage_of_active_pixels)
+
+    def __grab_frame_in_mode(self, slow_mode: bool):
+        # Runs in the executor, so that the camera is reconfigured by the
+        # same stage that grabs from it
+        power_mode = PowerMode.low if slow_mode else PowerMode.normal
+        if self.__power_saving and power_mode != self.__power_mode:
+            time_start = time.perf_counter()
+            self.__camera.set_power_mode(power_mode)
+            self.__power_mode = power_mode
+            logging.info('Camera switched to %s power mode in %.1f ms',
+                         power_mode.value,
+                         (time.perf_counter() - time_start) * 1000)
+        return self.__camera.grab_frame(slow_mode)
+
+    def __observe_sample_cpu_time(self, below_threshold: bool):
+        # CPU time of the whole process, camera threads included, from the
+        # start of one sample to the next, per regime of the first one
+        cpu_time = time.process_time()
+        if self.__previous_sample_cpu_time is not None:
+            self.__sample_cpu_time[
+                self.__previous_sample_below_threshold].observe(
+                    cpu_time - self.__previous_sample_cpu_time)
+        self.__previous_sample_cpu_time = cpu_time
+        self.__previous_sample_below_threshold = below_threshold
+
+    async def __grab_frame(self):
+        below_threshold = \
+            self.__activity_controller.activation_is_below_threshold
+        self.__observe_sample_cpu_time(below_threshold)
+        return await self.__event_loop.run_in_executor(
+            self.__executor, self.__grab_frame_in_mode, below_threshold)
+
+    def __image_is_needed(self):
+        return self.__send_image or \
+            not self.__activity_controller.activation_is_below_threshold
+
+    def __create_data_packet(self, percentage_of_active_pixels):
+        tiles = self.__image_processor.percentage_of_active_pixels_in_tiles
+        frame = self.__image_processor.frame
+        frame_age = time.monotonic() - frame.timestamp
+        self.__frame_age.observe(frame_age)
+        return DataPacketToServer(
+            percentage_of_active_pixels,
+            self.__activity_controller.activation_level,
+            self.__activity_controller.gain,
+            self.__activity_controller.sample_time,
+            None,
+            tiles.tolist() if tiles is not None else None,
+            self.__get_metrics_to_piggyback(),
+            capture_time=time.time() + self.__clock_offset - frame_age,
+            frame_sequence=frame.sequence
         )
 
-    def __encode_image_for_sending(self):
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
-        image_to_send = self.__image_processor.get_image(self.__image_type)
-        result, image_encoded = cv2.imencode('.jpg', image_to_send,
-                                             encode_param)
-        data = numpy.array(image_encoded)
-        image_as_string = data.tostring()
-        return image_as_string
+    async def __encode_images(self, packet, image):
+        time_start = time.perf_counter()
+        if self.__image_sender is None:
+            packet.image = await self.__event_loop.run_in_executor(
+                self.__executor, encode_image, image)
+        else:
+            packet.image, packet.image_regions = \
+                await self.__event_loop.run_in_executor(
+                    self.__executor, self.__image_sender.encode, image,
+                    packet.sample_time)
+        self.__encoding_time.observe(time.perf_counter() - time_start)
+
+        if packet.image is not None or packet.image_regions is not None:
+            self.__images_sent.inc()
+
+    def __get_metrics_to_piggyback(self):
+        if self.__metrics_piggyback_interval is None:
+            return None
+
+        current_time = time.perf_counter()
+        if current_time - self.__metrics_piggyback_time < \
+                self.__metrics_piggyback_interval:
+            return None
+
+        self.__metrics_piggyback_time = current_time
+        return metrics.registry.snapshot()
 
     def __process_data_packet(self, packet):
-        logging.debug('Received neighbour activation: %.2f'
-                      % packet.activation_neighbours)
+        logging.debug('Received neighbour activation: %.2f',
+                      packet.activation_neighbours)
 
         self.__activity_controller.set_params(
             activation_neighbours=packet.activation_neighbours
@@ -144,26 +368,39 @@ class VSNReactor:
             packet.parameters_above_threshold,
             packet.activation_level_threshold
         )
+        # Packets pickled by older servers do not carry the server time
+        server_time = getattr(packet, 'server_time', None)
+        if server_time is not None:
+            self.__clock_offset = server_time - time.time()
+            self.__scheduler.set_clock_offset(self.__clock_offset)
+
         if packet.node_id is not None:
-            # First configuration packet with node_id
+            # Configuration packet with node_id
             self.__node_id = packet.node_id
-            self.__client.send(ConfigurationPacketToServer(self.__node_id,
-                                                           __version__))
+            self.__configuration_sent = False
         elif self.__node_id is None and packet.hostname_based_ids:
             # First configuration packet without node_id
             try:
                 self.__node_id = int(''.join(
                     x for x in socket.gethostname() if x.isdigit()
                 ))
-                self.__client.send(ConfigurationPacketToServer(self.__node_id,
-                                                               __version__))
             except ValueError:
                 logging.critical('Client hostname does not provide '
                                  'camera number - exiting')
-                self.__client.disconnect()
+                self.__stop()
+                return
+
+        if self.__node_id is not None and not self.__configuration_sent:
+            self.__client.send(ConfigurationPacketToServer(
+                self.__node_id, __version__, protocol.PROTOCOL_VERSION))
+            self.__configuration_sent = True
 
-        if self.__waiting_for_configuration:
-            self.start()
+            if self.__datagram_settings.get('enabled', False):
+                self.__client.open_datagram_endpoint(
+                    self.__node_id,
+                    self.__datagram_settings.get('port', 50002),
+                    self.__datagram_settings.get('answer_timeout', 5.0),
+                    self.__datagram_settings.get('probe_interval', 5.0))
 
         if packet.image_type is not None:
             self.__image_type = packet.image_type
@@ -171,33 +408,154 @@ class VSNReactor:
         if packet.send_image is not None:
             self.__send_image = packet.send_image
 
+        self.__configuration_received.set()
+
     def __process_disconnect_packet(self, packet):
-        self.__update_task.cancel()
+        self.__stop()
+
+    def __process_connection_made(self, server_address: str):
+        # A new connection repeats the handshake, the server may have been
+        # restarted and forgotten the node
+        self.__configuration_sent = False
+        self.__discovery.remember(server_address)
+
+    def __stop(self):
+        self.__stopped = True
+        self.__configuration_received.set()
         self.__client.disconnect()
 
+    async def __wait_for_next_sample(self):
+        if self.__free_running:
+            await asyncio.sleep(0)
+        else:
+            await self.__scheduler.wait(
+                self.__activity_controller.sample_time)
+
     async def __run(self):
         while not self.__stopped:
+            await self.__wait_for_next_sample()
+
             time_start = time.perf_counter()
-            await self.__update()
-            time_end = time.perf_counter()
+            try:
+                await self.__update()
+            except EOFError:
+                logging.info('Camera has no more frames - exiting')
+                self.__stopped = True
+                break
+            self.__update_time.observe(time.perf_counter() - time_start)
+
+    async def __put(self, queue: asyncio.Queue, item, depth: metrics.Gauge):
+        if self.__pipeline_drop_policy == 'drop_oldest' and queue.full():
+            queue.get_nowait()
+            self.__dropped_frames.inc()
+        await queue.put(item)
+        depth.set(queue.qsize())
+
+    async def __capture_stage(self, frames: asyncio.Queue):
+        try:
+            while not self.__stopped:
+                # The sample time lags one frame behind the detection
+                await self.__wait_for_next_sample()
+
+                time_start = time.perf_counter()
+                frame = await self.__grab_frame()
+                self.__grab_time.observe(time.perf_counter() - time_start)
+
+                await self.__put(frames, frame, self.__frame_queue_depth)
+        except EOFError:
+            logging.info('Camera has no more frames - exiting')
+            self.__stopped = True
+        finally:
+            await frames.put(None)
+
+    async def __detection_stage(self, frames: asyncio.Queue,
+                                packets: asyncio.Queue):
+        while True:
+            frame = await frames.get()
+            self.__frame_queue_depth.set(frames.qsize())
+            if frame is None:
+                break
 
-            await asyncio.sleep(
-                self.__activity_controller.sample_time - (time_end - time_start)
+            time_start = time.perf_counter()
+            percentage_of_active_pixels = \
+                await self.__event_loop.run_in_executor(
+                    self.__executor,
+                    self.__image_processor.process_frame, frame
+                )
+
+            # Activation is only ever updated here, in the frame order
+            self.__activity_controller.update_sensor_state(
+                percentage_of_active_pixels
             )
+            self.__detection_time.observe(time.perf_counter() - time_start)
+            self.__activation_level.set(
+                self.__activity_controller.activation_level)
+            self.__sample_time.set(self.__activity_controller.sample_time)
+
+            image = None
+            if self.__image_is_needed():
+                # The processor overwrites its images with the next frame
+                image = self.__image_processor.get_image(
+                    self.__image_type).copy()
+
+            packet = self.__create_data_packet(percentage_of_active_pixels)
+            await self.__put(packets, (packet, image),
+                             self.__packet_queue_depth)
+
+        await packets.put(None)
+
+    async def __sending_stage(self, packets: asyncio.Queue):
+        while True:
+            item = await packets.get()
+            self.__packet_queue_depth.set(packets.qsize())
+            if item is None:
+                break
+
+            packet, image = item
+            if image is not None:
+                await self.__encode_images(packet, image)
+
+            if self.__client:
+                self.__client.send(packet)
+
+    async def __run_pipelined(self):
+        frames = asyncio.Queue(maxsize=self.__pipeline_queue_size)
+        packets = asyncio.Queue(maxsize=self.__pipeline_queue_size)
+
+        await asyncio.gather(self.__capture_stage(frames),
+                             self.__detection_stage(frames, packets),
+                             self.__sending_stage(packets))
+
+    async def __monitor_event_loop_lag(self):
+        interval = self.event_loop_lag_probe_interval
+        while True:
+            time_start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.__event_loop_lag.observe(
+                max(time.perf_counter() - time_start - interval, 0.0))
 
-    def __start(self):
-        if self.__node_id is not None:
-            self.__waiting_for_configuration = False
-        else:
-            self.__waiting_for_configuration = True
+    async def __run_monitored(self):
+        monitor = self.__event_loop.create_task(
+            self.__monitor_event_loop_lag())
+        try:
+            await self.__run_loop()
+        finally:
+            monitor.cancel()
+
+    async def __run_configured(self):
+        # Sampling depends on the parameters sent by the server
+        await self.__configuration_received.wait()
+        if not self.__stopped:
+            await self.__run_monitored()
 
+    def __start(self):
         try:
-            self.__event_loop.run_until_complete(self.__run())
+            self.__event_loop.run_until_complete(self.__run_configured())
         except KeyboardInterrupt:
             self.__stopped = True
 
     def __start_standalone(self):
         try:
-            self.__event_loop.run_until_complete(self.__run())
+            self.__event_loop.run_until_complete(self.__run_monitored())
         except KeyboardInterrupt:
             self.__stopped = True
@@ -0,0 +1,87 @@
+import asyncio
+import math
+import time
+from enum import Enum
+
+from vsn_client.common import metrics
+
+JITTER_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+class OverrunPolicy(Enum):
+    # Drop the missed sample instants and wait for the next one on the grid
+    skip = 'skip'
+    # Run the missed samples back to back until the grid is reached again
+    catch_up = 'catch_up'
+    # Restart the grid at the moment the overrun was noticed
+    stretch = 'stretch'
+
+
+class VSNDeadlineScheduler:
+    def __init__(self, overrun_policy: OverrunPolicy=OverrunPolicy.skip,
+                 align_to_server_clock: bool=False):
+        self.__overrun_policy = overrun_policy
+        self.__align_to_server_clock = align_to_server_clock
+        self.__clock_offset = 0.0
+        self.__deadline = None
+        self.__sample_time = None
+
+        self.__overruns = metrics.registry.counter(
+            'vsn_sample_time_overruns_total',
+            'Samples which started after their deadline')
+        self.__skipped_samples = metrics.registry.counter(
+            'vsn_skipped_samples_total',
+            'Sample instants dropped after an overrun')
+        self.__jitter = metrics.registry.histogram(
+            'vsn_sample_jitter_seconds',
+            'Delay between the deadline and the start of a sample',
+            JITTER_BUCKETS)
+        self.__maximum_jitter = metrics.registry.gauge(
+            'vsn_sample_jitter_max_seconds',
+            'Largest delay between the deadline and the start of a sample')
+
+    def set_clock_offset(self, clock_offset: float):
+        # Offset of the server wall clock from the local one, in seconds
+        self.__clock_offset = clock_offset
+        self.__deadline = None
+
+    def __aligned_deadline(self, now: float, sample_time: float) -> float:
+        server_time = time.time() + self.__clock_offset
+        aligned_server_time = math.ceil(server_time / sample_time) * \
+            sample_time
+        return now + (aligned_server_time - server_time)
+
+    def __next_deadline(self, now: float, sample_time: float) -> float:
+        if self.__deadline is None or (self.__align_to_server_clock and
+                                       sample_time != self.__sample_time):
+            # First sample or a switch to another grid
+            if self.__align_to_server_clock:
+                return self.__aligned_deadline(now, sample_time)
+            return now
+
+        deadline = self.__deadline + sample_time
+        if deadline >= now:
+            return deadline
+
+        self.__overruns.inc()
+        if self.__overrun_policy == OverrunPolicy.skip:
+            missed = math.ceil((now - deadline) / sample_time)
+            self.__skipped_samples.inc(missed)
+            deadline += missed * sample_time
+        elif self.__overrun_policy == OverrunPolicy.stretch:
+            deadline = now
+        return deadline
+
+    async def wait(self, sample_time: float):
+        now = time.monotonic()
+        # The clock offset may be reset while sleeping
+        deadline = self.__deadline = self.__next_deadline(now, sample_time)
+        self.__sample_time = sample_time
+
+        if deadline > now:
+            await asyncio.sleep(deadline - now)
+
+        jitter = max(time.monotonic() - deadline, 0.0)
+        self.__jitter.observe(jitter)
+        if jitter > self.__maximum_jitter.value:
+            self.__maximum_jitter.set(jitter)
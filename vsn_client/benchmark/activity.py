@@ -0,0 +1,124 @@
+import argparse
+import time
+
+import numpy as np
+
+from vsn_client.common.utility import Config
+from vsn_client.processing.activity import VSNActivityController, \
+    VSNBatchActivityController, SparseDependencies
+
+
+def _percentages(node_count: int, steps: int, seed: int=0):
+    # Bursts of activity on a quiet background, so that nodes cross the
+    # threshold in both directions
+    random = np.random.RandomState(seed)
+    percentages = random.exponential(0.5, (steps, node_count))
+    bursts = random.rand(steps, node_count) < 0.05
+    percentages[bursts] += random.uniform(5, 40, np.count_nonzero(bursts))
+    return percentages
+
+
+def _banded_dependencies(node_count: int, sparse: bool):
+    # Every node depends on the two nodes on each side, as in the default
+    # configuration of five cameras in a row
+    band = {-2: 0.2, -1: 0.5, 1: 0.5, 2: 0.2}
+    rows, columns, values = [], [], []
+    for offset, value in band.items():
+        nodes = np.arange(max(0, -offset), min(node_count,
+                                                node_count - offset))
+        rows.append(nodes)
+        columns.append(nodes + offset)
+        values.append(np.full(len(nodes), value))
+    rows, columns, values = (np.concatenate(x)
+                             for x in (rows, columns, values))
+
+    if sparse:
+        return SparseDependencies(rows, columns, values, node_count)
+    matrix = np.zeros((node_count, node_count))
+    matrix[rows, columns] = values
+    return matrix
+
+
+def _controller_arguments():
+    return (Config['clients']['parameters_below_threshold'],
+            Config['clients']['parameters_above_threshold'],
+            Config['clients']['activation_level_threshold'])
+
+
+def _run_scalar(percentages, neighbours=None):
+    steps, node_count = percentages.shape
+    controllers = [VSNActivityController(*_controller_arguments())
+                   for _ in range(node_count)]
+    activation_levels = np.empty((steps, node_count))
+    time_start = time.perf_counter()
+    for step in range(steps):
+        for node, controller in enumerate(controllers):
+            if neighbours is not None:
+                controller.set_params(
+                    activation_neighbours=neighbours[step, node])
+            controller.update_sensor_state(percentages[step, node])
+            activation_levels[step, node] = controller.activation_level
+    return (time.perf_counter() - time_start) / steps, activation_levels
+
+
+def _run_batch(percentages, dependencies=None):
+    steps, node_count = percentages.shape
+    controller = VSNBatchActivityController(
+        node_count, *_controller_arguments(), dependencies=dependencies)
+    activation_levels = np.empty((steps, node_count))
+    neighbours = np.empty((steps, node_count))
+    time_start = time.perf_counter()
+    for step in range(steps):
+        controller.update_sensor_state(percentages[step])
+        activation_levels[step] = controller.activation_level
+        neighbours[step] = controller.activation_neighbours
+    return ((time.perf_counter() - time_start) / steps, activation_levels,
+            neighbours)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the scalar activity controller with the batch '
+                    'one for growing numbers of nodes')
+    parser.add_argument('--nodes', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000])
+    parser.add_argument('--steps', type=int, default=100,
+                        help='updates per run (default: 100)')
+    parser.add_argument('--scalar-limit', dest='scalar_limit', type=int,
+                        default=1000,
+                        help='largest network run with the scalar '
+                             'controller (default: 1000)')
+    args = parser.parse_args()
+
+    print('%8s %12s %12s %12s %12s %10s' % ('nodes', 'scalar [ms]',
+                                            'batch [ms]', 'dense [ms]',
+                                            'sparse [ms]', 'identical'))
+    for node_count in args.nodes:
+        percentages = _percentages(node_count, args.steps)
+        batch_time, batch_levels, _ = _run_batch(percentages)
+
+        sparse_time, _, sparse_neighbours = _run_batch(
+            percentages, _banded_dependencies(node_count, sparse=True))
+        # A dense matrix of ten thousand nodes takes 800 MB
+        dense_time = float('nan')
+        if node_count <= 5000:
+            dense_time, _, _ = _run_batch(
+                percentages, _banded_dependencies(node_count, sparse=False))
+
+        scalar_time = float('nan')
+        identical = 'skipped'
+        if node_count <= args.scalar_limit:
+            scalar_time, scalar_levels = _run_scalar(percentages)
+            _, coupled_levels = _run_scalar(percentages, sparse_neighbours)
+            _, sparse_levels, _ = _run_batch(
+                percentages, _banded_dependencies(node_count, sparse=True))
+            identical = str(np.array_equal(scalar_levels, batch_levels) and
+                            np.array_equal(coupled_levels, sparse_levels))
+
+        print('%8d %12.3f %12.3f %12.3f %12.3f %10s' % (
+            node_count, scalar_time * 1000, batch_time * 1000,
+            dense_time * 1000, sparse_time * 1000, identical))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from vsn_client.acquisition.camera import VSNSyntheticCamera
+from vsn_client.benchmark.detection import _recorded_frames
+from vsn_client.processing.background import BACKGROUND_MODELS
+from vsn_client.processing.image import VSNImageProcessor
+
+
+def _synthetic_frames(width: int, height: int, count: int):
+    # Quarters of the sequence alternate between the empty scene and the
+    # same scene with moving blobs
+    cameras = (VSNSyntheticCamera(width, height, number_of_blobs=0),
+               VSNSyntheticCamera(width, height))
+    return [cameras[i * 4 // count % 2].grab_image() for i in range(count)]
+
+
+def _relit(frames, step: float, ramp: float):
+    # Lights slowly brightening over the whole sequence, and switched on in
+    # the middle of it
+    count = len(frames)
+    return [cv2.convertScaleAbs(frame, alpha=1.0 + ramp * i / count +
+                                (step if i >= count // 2 else 0.0))
+            for i, frame in enumerate(frames)]
+
+
+def _run(frames, model: str, parameters: dict=None,
+         stable_update_interval: int=None):
+    processor = VSNImageProcessor(
+        frames[0], preallocate=True, background_model=model,
+        background_parameters=parameters,
+        stable_update_interval=stable_update_interval)
+    percentages = np.empty(len(frames))
+    time_start = time.perf_counter()
+    for i, frame in enumerate(frames):
+        percentages[i] = \
+            processor.get_percentage_of_active_pixels_in_frame(frame)
+    return (time.perf_counter() - time_start) / len(frames), percentages
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the cost of the background models, their '
+                    'detection of activity and their false triggers when '
+                    'the lighting changes')
+    parser.add_argument('--video', type=str, default=None,
+                        help='recorded sequence (default: synthetic frames)')
+    parser.add_argument('--width', type=int, default=320)
+    parser.add_argument('--height', type=int, default=240)
+    parser.add_argument('-n', dest='number', type=int, default=300,
+                        help='number of frames (default: 300)')
+    parser.add_argument('--models', type=str, nargs='+',
+                        default=sorted(BACKGROUND_MODELS))
+    parser.add_argument('--learning-rate', dest='learning_rate', type=float,
+                        default=None,
+                        help='learning rate of the models having one')
+    parser.add_argument('--brightness-step', dest='brightness_step',
+                        type=float, default=0.3,
+                        help='relative brightness change halfway through '
+                             'the sequence (default: 0.3)')
+    parser.add_argument('--brightness-ramp', dest='brightness_ramp',
+                        type=float, default=0.2,
+                        help='relative brightness change spread over the '
+                             'sequence (default: 0.2)')
+    parser.add_argument('--threshold', type=float, default=1.0,
+                        help='percentage of active pixels counted as '
+                             'activity (default: 1.0)')
+    parser.add_argument('--stable-update-interval',
+                        dest='stable_update_interval', type=int,
+                        default=None,
+                        help='skip the detection of frames of a stable '
+                             'scene, learning every n-th of them '
+                             '(default: process every frame)')
+    args = parser.parse_args()
+
+    if args.video:
+        frames = _recorded_frames(args.video, args.number)
+    else:
+        frames = _synthetic_frames(args.width, args.height, args.number)
+    relit_frames = _relit(frames, args.brightness_step, args.brightness_ramp)
+    parameters = None if args.learning_rate is None else \
+        {'learning_rate': args.learning_rate}
+
+    # Activity as seen by the approximate median without lighting changes
+    _, reference = _run(frames, 'approximate_median')
+    reference_active = reference > args.threshold
+
+    # missed: frames active for the reference but not for the model;
+    # false triggers: frames active only once the lighting changes
+    print('%-20s %10s %9s %10s %16s' % ('model', 'us/frame', 'active %',
+                                        'missed %', 'false trigger %'))
+    for model in args.models:
+        model_parameters = parameters if model != 'approximate_median' \
+            else None
+        frame_time, percentages = _run(frames, model, model_parameters,
+                                       args.stable_update_interval)
+        _, relit_percentages = _run(relit_frames, model, model_parameters,
+                                    args.stable_update_interval)
+        active = percentages > args.threshold
+        relit_active = relit_percentages > args.threshold
+        print('%-20s %10.1f %9.1f %10.1f %16.1f' % (
+            model,
+            frame_time * 1e6,
+            np.mean(active) * 100,
+            np.mean(reference_active & ~active) * 100,
+            np.mean(relit_active & ~active) * 100
+        ))
+
+
+if __name__ == '__main__':
+    main()
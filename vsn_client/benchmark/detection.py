@@ -0,0 +1,75 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from vsn_client.benchmark.image import _frames
+from vsn_client.processing.image import VSNImageProcessor
+
+
+def _recorded_frames(path: str, count: int):
+    capture = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < count:
+        result, frame = capture.read()
+        if not result:
+            break
+        frames.append(frame)
+    capture.release()
+    if not frames:
+        raise SystemExit('Could not read any frame from %s' % path)
+    return frames
+
+
+def _run(frames, detection_scale: float):
+    processor = VSNImageProcessor(frames[0], preallocate=True,
+                                  detection_scale=detection_scale)
+    percentages = np.empty(len(frames))
+    time_start = time.perf_counter()
+    for i, frame in enumerate(frames):
+        percentages[i] = \
+            processor.get_percentage_of_active_pixels_in_frame(frame)
+    return (time.perf_counter() - time_start) / len(frames), percentages
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare detection cost and accuracy when the background '
+                    'subtraction runs on downscaled frames')
+    parser.add_argument('--video', type=str, default=None,
+                        help='recorded sequence (default: synthetic frames)')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('-n', dest='number', type=int, default=300,
+                        help='number of frames (default: 300)')
+    parser.add_argument('--scales', type=float, nargs='+',
+                        default=[1.0, 0.75, 0.5, 0.25])
+    parser.add_argument('--threshold', type=float, default=1.0,
+                        help='percentage of active pixels counted as '
+                             'activity (default: 1.0)')
+    args = parser.parse_args()
+
+    if args.video:
+        frames = _recorded_frames(args.video, args.number)
+    else:
+        frames = _frames(args.width, args.height, args.number)
+
+    reference_time, reference = _run(frames, 1.0)
+    reference_active = reference > args.threshold
+
+    print('%-7s %10s %9s %12s %12s' %
+          ('scale', 'us/frame', 'speedup', 'mean abs err', 'agreement %'))
+    for scale in args.scales:
+        frame_time, percentages = _run(frames, scale)
+        print('%-7.2f %10.1f %9.2f %12.3f %12.1f' % (
+            scale,
+            frame_time * 1e6,
+            reference_time / frame_time,
+            np.mean(np.abs(percentages - reference)),
+            np.mean((percentages > args.threshold) == reference_active) * 100
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from vsn_client.acquisition.camera import VSNSyntheticCamera
+from vsn_client.processing.image import VSNImageProcessor
+
+
+def _frames(width: int, height: int, count: int, seed: int=0):
+    camera = VSNSyntheticCamera(width, height, seed=seed)
+    return [camera.grab_image() for _ in range(count)]
+
+
+def _allocated_bytes(function) -> int:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - baseline
+
+
+def _mean_time(function, repetitions: int) -> float:
+    time_start = time.perf_counter()
+    for _ in range(repetitions):
+        function()
+    return (time.perf_counter() - time_start) / repetitions
+
+
+def _stages(frame, background):
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    difference = cv2.absdiff(background, gray)
+    blurred = cv2.medianBlur(difference, 3)
+    thresholded = cv2.compare(blurred, 6, cv2.CMP_GT)
+    eroded = cv2.erode(thresholded, kernel)
+    dst = np.empty_like(gray)
+    bound = np.empty_like(gray)
+    updated = background.copy()
+
+    def background_allocating():
+        updated[...] = background
+        mask_gt = np.greater(updated, gray)
+        mask_lt = np.less(updated, gray)
+        updated[...] += mask_lt
+        updated[...] -= mask_gt
+
+    def background_in_place():
+        updated[...] = background
+        cv2.add(updated, 1, dst=bound)
+        cv2.min(gray, bound, dst=bound)
+        cv2.subtract(updated, 1, dst=updated)
+        cv2.max(bound, updated, dst=updated)
+
+    return (
+        ('cvtColor',
+         lambda: cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+         lambda: cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=dst)),
+        ('absdiff',
+         lambda: cv2.absdiff(background, gray),
+         lambda: cv2.absdiff(background, gray, dst=dst)),
+        ('medianBlur',
+         lambda: cv2.medianBlur(difference, 3),
+         lambda: cv2.medianBlur(difference, 3, dst=dst)),
+        ('compare',
+         lambda: cv2.compare(blurred, 6, cv2.CMP_GT),
+         lambda: cv2.compare(blurred, 6, cv2.CMP_GT, dst=dst)),
+        ('erode',
+         lambda: cv2.erode(thresholded, kernel),
+         lambda: cv2.erode(thresholded, kernel, dst=dst)),
+        ('dilate',
+         lambda: cv2.dilate(eroded, kernel),
+         lambda: cv2.dilate(eroded, kernel, dst=dst)),
+        ('background', background_allocating, background_in_place)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the allocating and the preallocated image '
+                    'processing pipelines stage by stage')
+    parser.add_argument('--width', type=int, default=320)
+    parser.add_argument('--height', type=int, default=240)
+    parser.add_argument('-n', dest='number', type=int, default=500,
+                        help='repetitions per measurement (default: 500)')
+    args = parser.parse_args()
+
+    frames = _frames(args.width, args.height, 2)
+    background = cv2.cvtColor(frames[0], cv2.COLOR_BGR2GRAY)
+
+    print('%-12s %12s %12s %12s %12s' %
+          ('stage', 'alloc us', 'in-place us', 'alloc B', 'in-place B'))
+    for name, allocating, in_place in _stages(frames[1], background):
+        print('%-12s %12.1f %12.1f %12d %12d' % (
+            name,
+            _mean_time(allocating, args.number) * 1e6,
+            _mean_time(in_place, args.number) * 1e6,
+            _allocated_bytes(allocating),
+            _allocated_bytes(in_place)
+        ))
+
+    frames = _frames(args.width, args.height, args.number)
+    for preallocate in (False, True):
+        processor = VSNImageProcessor(frames[0], preallocate=preallocate)
+        frames_iterator = iter(frames * 2)
+        print('%-12s %12.1f us/frame %10d B/frame' % (
+            'preallocated' if preallocate else 'allocating',
+            _mean_time(lambda: processor.
+                       get_percentage_of_active_pixels_in_frame(
+                           next(frames_iterator)), args.number) * 1e6,
+            _allocated_bytes(lambda: processor.
+                             get_percentage_of_active_pixels_in_frame(
+                                 next(frames_iterator)))
+        ))
+
+
+if __name__ == '__main__':
+    main()
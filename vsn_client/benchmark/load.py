@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import collections
+import json
+import platform
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from vsn_client import __version__
+from vsn_client.acquisition.camera import VSNSyntheticCamera
+from vsn_client.acquisition.scheduler import VSNDeadlineScheduler
+from vsn_client.benchmark.reactor import _percentiles
+from vsn_client.common.packet import ClientPacketRouter, \
+    ConfigurationPacketToServer, DataPacketToServer
+from vsn_client.common.utility import Config
+from vsn_client.connectivity import protocol
+from vsn_client.connectivity.client import VSNClient
+from vsn_client.connectivity.server import VSNReferenceServer
+from vsn_client.processing.activity import VSNActivityController
+from vsn_client.processing.image import VSNImageProcessor
+
+
+class _SimulatedNode:
+    # Synthetic frames through the detection and activity control of a real
+    # node, sent over the real client connection
+    def __init__(self, server_address: str, server_port: int,
+                 protocol_version: int, datagram_port: int, width: int,
+                 height: int, blobs: int, seed: int):
+        self.__camera = VSNSyntheticCamera(width, height,
+                                           number_of_blobs=blobs, seed=seed)
+        self.__image_processor = VSNImageProcessor(self.__camera.grab_image(),
+                                                   preallocate=True)
+        self.__activity_controller = VSNActivityController(
+            Config['clients']['parameters_below_threshold'],
+            Config['clients']['parameters_above_threshold'],
+            Config['clients']['activation_level_threshold']
+        )
+        self.__scheduler = VSNDeadlineScheduler()
+        self.__datagram_port = datagram_port
+        self.__send_times = collections.deque()
+        self.__stopped = False
+
+        self.packets_sent = 0
+        self.round_trip_times = []
+
+        self.__client = VSNClient(
+            server_address, server_port,
+            ClientPacketRouter(self.__process_data_packet,
+                               self.__process_configuration_packet,
+                               self.__process_disconnect_packet),
+            protocol_version=protocol_version
+        )
+
+    def disconnect(self):
+        self.__client.disconnect()
+
+    def __process_data_packet(self, packet):
+        # The server answers the data packets of a node in order
+        self.round_trip_times.append(
+            time.perf_counter() - self.__send_times.popleft())
+        self.__activity_controller.set_params(
+            activation_neighbours=packet.activation_neighbours)
+
+    def __process_configuration_packet(self, packet):
+        if packet.node_id is not None:
+            self.__client.send(ConfigurationPacketToServer(
+                packet.node_id, __version__, protocol.PROTOCOL_VERSION))
+            if self.__datagram_port is not None:
+                self.__client.open_datagram_endpoint(packet.node_id,
+                                                     self.__datagram_port)
+
+    def __process_disconnect_packet(self, packet):
+        self.__stopped = True
+
+    async def run(self, duration: float, sample_time: float=None):
+        # Spread the first samples so that the nodes do not send in bursts
+        await asyncio.sleep(random.uniform(
+            0, sample_time or self.__activity_controller.sample_time))
+
+        time_end = time.perf_counter() + duration
+        while not self.__stopped and time.perf_counter() < time_end:
+            await self.__scheduler.wait(
+                sample_time or self.__activity_controller.sample_time)
+
+            frame = self.__camera.grab_frame(
+                self.__activity_controller.activation_is_below_threshold)
+            percentage_of_active_pixels = \
+                self.__image_processor.process_frame(frame)
+            self.__activity_controller.update_sensor_state(
+                percentage_of_active_pixels)
+
+            self.__send_times.append(time.perf_counter())
+            self.__client.send(DataPacketToServer(
+                percentage_of_active_pixels,
+                self.__activity_controller.activation_level,
+                self.__activity_controller.gain,
+                self.__activity_controller.sample_time,
+                capture_time=time.time() - (time.monotonic() -
+                                            frame.timestamp),
+                frame_sequence=frame.sequence
+            ))
+            self.packets_sent += 1
+
+
+def _run_nodes(server_address: str, server_port: int, protocol_version: int,
+               datagram_port: int, nodes: int, first_seed: int,
+               duration: float, width: int, height: int, blobs: int,
+               sample_time: float) -> dict:
+    # Worker processes must not reuse the event loop of the parent
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    simulated_nodes = [
+        _SimulatedNode(server_address, server_port, protocol_version,
+                       datagram_port, width, height, blobs, first_seed + i)
+        for i in range(nodes)
+    ]
+
+    cpu_start = time.process_time()
+    time_start = time.time()
+    loop.run_until_complete(asyncio.gather(
+        *(node.run(duration, sample_time) for node in simulated_nodes)))
+    # Let the last answers arrive
+    loop.run_until_complete(asyncio.sleep(0.5))
+    time_end = time.time()
+    cpu_seconds = time.process_time() - cpu_start
+
+    for node in simulated_nodes:
+        node.disconnect()
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+    return {
+        'packets_sent': sum(node.packets_sent for node in simulated_nodes),
+        'round_trip_times': [t for node in simulated_nodes
+                             for t in node.round_trip_times],
+        'time_start': time_start,
+        'time_end': time_end,
+        'cpu_seconds': cpu_seconds
+    }
+
+
+async def _run_load(server: VSNReferenceServer, args,
+                    protocol_version: int) -> dict:
+    loop = asyncio.get_event_loop()
+    nodes_per_process = [args.clients // args.processes +
+                         (1 if i < args.clients % args.processes else 0)
+                         for i in range(args.processes)]
+
+    with ProcessPoolExecutor(args.processes) as executor:
+        results = await asyncio.gather(*(
+            loop.run_in_executor(
+                executor, _run_nodes, '127.0.0.1', server.port,
+                protocol_version,
+                server.datagram_port if args.datagrams else None,
+                nodes, sum(nodes_per_process[:i]),
+                args.duration, args.width, args.height, args.blobs,
+                args.sample_time)
+            for i, nodes in enumerate(nodes_per_process) if nodes
+        ))
+
+    elapsed = max(result['time_end'] for result in results) - \
+        min(result['time_start'] for result in results)
+    round_trip_times = [t for result in results
+                        for t in result['round_trip_times']]
+    packets_sent = sum(result['packets_sent'] for result in results)
+    return {
+        'elapsed': elapsed,
+        'packets_sent': packets_sent,
+        'packets_per_second': packets_sent / elapsed,
+        'answers_received': len(round_trip_times),
+        'round_trip': _percentiles(round_trip_times)
+        if round_trip_times else None,
+        'client_cpu_seconds': sum(result['cpu_seconds']
+                                  for result in results)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run many simulated nodes against a local reference '
+                    'server and print the throughput, round trip latency '
+                    'and server CPU usage as JSON')
+    parser.add_argument('-c', dest='clients', type=int, default=100,
+                        help='simulated nodes (default: 100)')
+    parser.add_argument('-p', dest='processes', type=int, default=1,
+                        help='processes running the nodes (default: 1)')
+    parser.add_argument('-d', dest='duration', type=float, default=10.0,
+                        help='seconds of sending per node (default: 10)')
+    parser.add_argument('--sample-time', dest='sample_time', type=float,
+                        default=None,
+                        help='fixed sample time of every node (default: the '
+                             'one chosen by the activity controller)')
+    parser.add_argument('--width', type=int, default=160)
+    parser.add_argument('--height', type=int, default=120)
+    parser.add_argument('--blobs', type=int, default=2,
+                        help='moving blobs per node (default: 2)')
+    parser.add_argument('--legacy', action='store_true', default=False,
+                        help='use the legacy pickle framing')
+    parser.add_argument('--datagrams', action='store_true', default=False,
+                        help='send the data packets over UDP')
+    parser.add_argument('-o', dest='output', type=str, default=None,
+                        help='write the JSON report to a file')
+    args = parser.parse_args()
+
+    protocol_version = protocol.LEGACY_PROTOCOL_VERSION if args.legacy \
+        else protocol.PROTOCOL_VERSION
+
+    loop = asyncio.get_event_loop()
+    server = VSNReferenceServer(protocol_version)
+    loop.run_until_complete(server.start(
+        datagram_port=0 if args.datagrams else None))
+
+    # The nodes run in other processes, so this is the CPU of the server
+    cpu_start = time.process_time()
+    result = loop.run_until_complete(_run_load(server, args,
+                                               protocol_version))
+    server_cpu_seconds = time.process_time() - cpu_start
+    server.close()
+
+    result.update(
+        clients=args.clients,
+        processes=args.processes,
+        datagrams=args.datagrams,
+        packets_received=server.packets_received,
+        datagrams_received=server.datagrams_received,
+        stale_datagrams=server.stale_datagrams,
+        stale_frames=server.stale_frames,
+        capture_to_receive=_percentiles(server.capture_latencies)
+        if server.capture_latencies else None,
+        bytes_received=server.bytes_received,
+        server_cpu_seconds=server_cpu_seconds,
+        server_cpu_percent=server_cpu_seconds / result['elapsed'] * 100,
+        server_peak_rss_kb=resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+    )
+
+    report = json.dumps({
+        'version': __version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'protocol_version': protocol_version,
+        'result': result
+    }, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(report)
+    else:
+        sys.stdout.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
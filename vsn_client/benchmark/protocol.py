@@ -0,0 +1,59 @@
+import argparse
+import os
+import timeit
+
+from vsn_client.common.packet import ConfigurationPacketToClient, \
+    DataPacketToServer, DataPacketToClient
+from vsn_client.common.utility import ImageType
+from vsn_client.connectivity import protocol
+
+
+def _round_trip(packet, protocol_version):
+    buffers = protocol.encode(packet, protocol_version)
+    payload = b''.join(buffers)[protocol.LENGTH_SIZE:]
+    return protocol.decode(payload, allow_legacy=True)
+
+
+def _packets(image_size: int):
+    return (
+        ('data', DataPacketToServer(12.5, 3.25, 2, 1)),
+        ('data+image', DataPacketToServer(12.5, 3.25, 0.1, 0.1,
+                                          os.urandom(image_size))),
+        ('neighbours', DataPacketToClient(4.75)),
+        ('configuration', ConfigurationPacketToClient(
+            3, True, ImageType.difference,
+            protocol_version=protocol.PROTOCOL_VERSION))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the binary wire protocol with pickle framing')
+    parser.add_argument('-n', dest='number', type=int, default=20000,
+                        help='round trips per measurement (default: 20000)')
+    parser.add_argument('--image-size', dest='image_size', type=int,
+                        default=12000,
+                        help='JPEG payload size in bytes (default: 12000)')
+    args = parser.parse_args()
+
+    versions = (('pickle', protocol.LEGACY_PROTOCOL_VERSION),
+                ('binary', protocol.PROTOCOL_VERSION))
+
+    print('%-14s %-7s %8s %12s %14s' %
+          ('packet', 'format', 'bytes', 'us/round', 'packets/s'))
+    for name, packet in _packets(args.image_size):
+        for version_name, version in versions:
+            decoded = _round_trip(packet, version)
+            assert vars(decoded) == vars(packet), (name, version_name)
+
+            size = sum(len(memoryview(b).cast('B'))
+                       for b in protocol.encode(packet, version))
+            seconds = timeit.timeit(lambda: _round_trip(packet, version),
+                                    number=args.number)
+            print('%-14s %-7s %8d %12.2f %14.0f' %
+                  (name, version_name, size, seconds / args.number * 1e6,
+                   args.number / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+from vsn_client import __version__
+from vsn_client.acquisition.camera import VSNSyntheticCamera
+from vsn_client.common.packet import DataPacketToServer
+from vsn_client.common.utility import Config, ImageType
+from vsn_client.connectivity import protocol
+from vsn_client.connectivity.client_base import TCPClient
+from vsn_client.connectivity.server import VSNReferenceServer
+from vsn_client.processing.activity import VSNActivityController
+from vsn_client.processing.image import VSNImageProcessor, encode_image
+
+STAGES = ('grab', 'detect', 'activity', 'encode', 'send')
+
+
+class _BenchmarkClient(TCPClient):
+    def connection_made(self):
+        pass
+
+    def connection_lost(self, deliberate):
+        pass
+
+    def data_received(self, received_object: object):
+        pass
+
+
+def _percentiles(samples: list) -> dict:
+    samples = np.array(samples) * 1000
+    return {'mean_ms': float(np.mean(samples)),
+            'p50_ms': float(np.percentile(samples, 50)),
+            'p99_ms': float(np.percentile(samples, 99))}
+
+
+async def _run_scenario(camera, processor, controller, client, server,
+                        frames: int, send_image: bool):
+    timings = {stage: [] for stage in STAGES}
+    images_sent = 0
+    bytes_before = server.bytes_received
+    packets_sent = server.packets_received
+
+    time_start = time.perf_counter()
+    for _ in range(frames):
+        t0 = time.perf_counter()
+        frame = camera.grab_image(
+            slow_mode=controller.activation_is_below_threshold)
+        t1 = time.perf_counter()
+        percentage = processor.get_percentage_of_active_pixels_in_frame(
+            frame)
+        t2 = time.perf_counter()
+        controller.update_sensor_state(percentage)
+        t3 = time.perf_counter()
+
+        encoded_image = None
+        if send_image or not controller.activation_is_below_threshold:
+            encoded_image = encode_image(
+                processor.get_image(ImageType.foreground))
+            images_sent += 1
+        t4 = time.perf_counter()
+
+        client.send(DataPacketToServer(percentage,
+                                       controller.activation_level,
+                                       controller.gain,
+                                       controller.sample_time,
+                                       encoded_image))
+        packets_sent += 1
+        await server.wait_for_packet(packets_sent)
+        t5 = time.perf_counter()
+
+        for stage, start, end in zip(STAGES, (t0, t1, t2, t3, t4),
+                                     (t1, t2, t3, t4, t5)):
+            timings[stage].append(end - start)
+    elapsed = time.perf_counter() - time_start
+
+    bytes_on_wire = server.bytes_received - bytes_before
+    return {
+        'frames': frames,
+        'frames_per_second': frames / elapsed,
+        'images_sent': images_sent,
+        'bytes_on_wire': bytes_on_wire,
+        'bytes_per_frame': bytes_on_wire / frames,
+        'stages': {stage: _percentiles(samples)
+                   for stage, samples in timings.items()},
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def _benchmark(arguments: tuple) -> dict:
+    # Runs in a process of its own, so that the peak memory of a scenario
+    # is not inherited from the ones before it
+    width, height, blobs, frames, send_image, protocol_version = arguments
+
+    loop = asyncio.get_event_loop()
+    server = VSNReferenceServer(protocol_version)
+    loop.run_until_complete(server.start())
+    client = _BenchmarkClient('127.0.0.1', server.port, protocol_version)
+
+    camera = VSNSyntheticCamera(width, height, number_of_blobs=blobs)
+    processor = VSNImageProcessor(camera.grab_image(), preallocate=True)
+    controller = VSNActivityController(
+        Config['clients']['parameters_below_threshold'],
+        Config['clients']['parameters_above_threshold'],
+        Config['clients']['activation_level_threshold']
+    )
+    result = loop.run_until_complete(_run_scenario(
+        camera, processor, controller, client, server, frames, send_image))
+    result.update(width=width, height=height, blobs=blobs,
+                  protocol_version=client.protocol_version)
+
+    client.disconnect()
+    server.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the reactor hot path against a local reference '
+                    'server and print the results as JSON')
+    parser.add_argument('-n', dest='frames', type=int, default=200,
+                        help='frames per scenario (default: 200)')
+    parser.add_argument('--resolutions', type=str, nargs='+',
+                        default=['320x240', '640x480'],
+                        help='WIDTHxHEIGHT (default: 320x240 640x480)')
+    parser.add_argument('--blobs', type=int, nargs='+', default=[0, 2, 8],
+                        help='moving blobs per scenario, i.e. activity '
+                             'levels (default: 0 2 8)')
+    parser.add_argument('--send-image', dest='send_image',
+                        action='store_true', default=False,
+                        help='send the image with every packet, as when '
+                             'requested by the server')
+    parser.add_argument('--legacy', action='store_true', default=False,
+                        help='use the legacy pickle framing')
+    parser.add_argument('-o', dest='output', type=str, default=None,
+                        help='write the JSON report to a file')
+    args = parser.parse_args()
+
+    protocol_version = protocol.LEGACY_PROTOCOL_VERSION if args.legacy \
+        else protocol.PROTOCOL_VERSION
+
+    scenarios = []
+    for resolution in args.resolutions:
+        width, height = (int(x) for x in resolution.split('x'))
+        for blobs in args.blobs:
+            scenarios.append((width, height, blobs, args.frames,
+                              args.send_image, protocol_version))
+
+    # One scenario at a time, each in a fresh process
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        results = pool.map(_benchmark, scenarios, chunksize=1)
+
+    # Every scenario negotiates the same version with the local server
+    negotiated_versions = [result.pop('protocol_version')
+                           for result in results]
+    report = json.dumps({
+        'version': __version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'protocol_version': negotiated_versions[0],
+        'results': results
+    }, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(report)
+    else:
+        sys.stdout.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +0,0 @@
-def autoinitialized(cls):
-    cls.initialize()
-    return cls
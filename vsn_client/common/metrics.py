@@ -0,0 +1,147 @@
+import asyncio
+import bisect
+import logging
+
+# Upper bounds in seconds, suitable for the per-stage timings of the reactor
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5)
+
+
+class Counter:
+    __slots__ = ('name', 'description', 'value')
+
+    def __init__(self, name: str, description: str=''):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Gauge:
+    __slots__ = ('name', 'description', 'value')
+
+    def __init__(self, name: str, description: str=''):
+        self.name = name
+        self.description = description
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Histogram:
+    __slots__ = ('name', 'description', 'buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, name: str, description: str='',
+                 buckets: tuple=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        # The last slot counts the observations above the highest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '%s_bucket{le="%g"}' % (self.name, bound), cumulative
+        yield '%s_bucket{le="+Inf"}' % self.name, self.count
+        yield self.name + '_sum', self.sum
+        yield self.name + '_count', self.count
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.__metrics = {}
+
+    def __register(self, metric_type, name: str, *args):
+        try:
+            metric = self.__metrics[name]
+        except KeyError:
+            metric = self.__metrics[name] = metric_type(name, *args)
+
+        if not isinstance(metric, metric_type):
+            raise TypeError('Metric %s is already registered as %s' %
+                            (name, type(metric).__name__))
+        return metric
+
+    def counter(self, name: str, description: str='') -> Counter:
+        return self.__register(Counter, name, description)
+
+    def gauge(self, name: str, description: str='') -> Gauge:
+        return self.__register(Gauge, name, description)
+
+    def histogram(self, name: str, description: str='',
+                  buckets: tuple=DEFAULT_BUCKETS) -> Histogram:
+        return self.__register(Histogram, name, description, buckets)
+
+    def snapshot(self) -> dict:
+        # Counters, gauges and histogram totals, without the buckets
+        snapshot = {}
+        for metric in self.__metrics.values():
+            if isinstance(metric, Histogram):
+                snapshot[metric.name + '_sum'] = metric.sum
+                snapshot[metric.name + '_count'] = metric.count
+            else:
+                snapshot[metric.name] = metric.value
+        return snapshot
+
+    def to_text(self) -> str:
+        lines = []
+        for metric in self.__metrics.values():
+            if metric.description:
+                lines.append('# HELP %s %s' % (metric.name,
+                                                metric.description))
+            lines.append('# TYPE %s %s' % (metric.name,
+                                            type(metric).__name__.lower()))
+            lines.extend('%s %s' % (name, repr(float(value)))
+                         for name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+async def _handle_metrics_request(metrics_registry: MetricsRegistry,
+                                  reader, writer):
+    try:
+        # Only the request line matters, every path returns the metrics
+        await reader.readline()
+        body = metrics_registry.to_text().encode('utf8')
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: %d\r\n\r\n' % len(body) + body)
+        await writer.drain()
+    except ConnectionError as e:
+        logging.debug('Metrics request failed: %s', e)
+    finally:
+        writer.close()
+
+
+def start_http_server(port: int, host: str='127.0.0.1',
+                      metrics_registry: MetricsRegistry=registry):
+    return asyncio.start_server(
+        lambda reader, writer: _handle_metrics_request(metrics_registry,
+                                                       reader, writer),
+        host, port)
@@ -3,36 +3,55 @@ from vsn_client.common.utility import Config
 
 class ConfigurationPacketToClient:
     def __init__(self, node_id: int=None, send_image=None, image_type=None,
-                 pkgs_to_update: list=None):
+                 pkgs_to_update: list=None, protocol_version: int=None,
+                 server_time: float=None):
         self.node_id = node_id
         self.image_type = image_type
         self.send_image = send_image
         self.pkgs_to_update = pkgs_to_update
-        self.hostname_based_ids = Config['clients']['hostname_based_ids']
-        self.image_size = Config['clients']['image_size']
-        self.frame_rate = Config['clients']['frame_rate']
-        self.parameters_below_threshold = Config['clients'][
-            'parameters_below_threshold']
-        self.parameters_above_threshold = Config['clients'][
-            'parameters_above_threshold']
-        self.activation_level_threshold = Config['clients'][
-            'activation_level_threshold']
+        settings = Config.client_settings()
+        self.hostname_based_ids = settings.hostname_based_ids
+        # Plain dictionaries, as expected by servers and clients unpickling
+        # the packet
+        self.image_size = settings.image_size._asdict()
+        self.frame_rate = settings.frame_rate
+        self.parameters_below_threshold = \
+            settings.parameters_below_threshold._asdict()
+        self.parameters_above_threshold = \
+            settings.parameters_above_threshold._asdict()
+        self.activation_level_threshold = settings.activation_level_threshold
+        self.protocol_version = protocol_version
+        # Wall clock of the server at sending, for aligning the sampling
+        self.server_time = server_time
 
 
 class ConfigurationPacketToServer:
-    def __init__(self, node_id: int, software_version: str):
+    def __init__(self, node_id: int, software_version: str,
+                 protocol_version: int=None):
         self.node_id = node_id
         self.software_version = software_version
+        self.protocol_version = protocol_version
 
 
 class DataPacketToServer:
     def __init__(self, white_pixels: float, activation_level: float,
-                 gain: float, sample_time: float, image=None):
+                 gain: float, sample_time: float, image=None,
+                 tiles: list=None, metrics: dict=None,
+                 image_regions: list=None, capture_time: float=None,
+                 frame_sequence: int=None):
         self.white_pixels = white_pixels
         self.activation_level = activation_level
         self.gain = gain
         self.sample_time = sample_time
         self.image = image
+        self.tiles = tiles
+        self.metrics = metrics
+        # (x, y, encoded_image) patches onto the last whole image
+        self.image_regions = image_regions
+        # Wall clock time of the capture of the frame, in the clock of the
+        # server once known, and its number among the frames of the camera
+        self.capture_time = capture_time
+        self.frame_sequence = frame_sequence
 
 
 class DataPacketToClient:
@@ -0,0 +1,24 @@
+import sys
+import time
+
+
+class StartupProfile:
+    # Durations of the steps of starting a client, printed with
+    # --profile-startup to see what delays restarts of the nodes
+    def __init__(self):
+        self.__steps = []
+        self.__time_start = time.perf_counter()
+        self.__time_last = self.__time_start
+
+    def step(self, name: str):
+        now = time.perf_counter()
+        self.__steps.append((name, now - self.__time_last))
+        self.__time_last = now
+
+    def report(self, stream=sys.stderr):
+        total = self.__time_last - self.__time_start
+        for name, duration in self.__steps:
+            print('%-24s %9.1f ms %6.1f %%' % (
+                name, duration * 1000,
+                100 * duration / total if total else 0.0), file=stream)
+        print('%-24s %9.1f ms' % ('total', total * 1000), file=stream)
@@ -1,25 +1,43 @@
+import logging
 import os
 import sys
 from enum import Enum
 from collections import namedtuple
 
-import yaml
-
-from vsn_client.common.decorators import autoinitialized
-
 
 class ConfigMeta(type):
     def __getitem__(self, name):
-        return self._settings[name]
+        return self._loaded_settings()[name]
 
     def __setitem__(self, key, value):
-        self._settings[key] = value
+        self._loaded_settings()[key] = value
+
+
+# Settings read for every configuration packet, converted once per load
+GainSampletimeTuple = namedtuple('GainSampletimeTuple', ['gain', 'sample_time'])
+ImageSizeTuple = namedtuple('ImageSizeTuple', ['width', 'height'])
+ClientSettingsTuple = namedtuple('ClientSettingsTuple', [
+    'hostname_based_ids', 'image_size', 'frame_rate',
+    'parameters_below_threshold', 'parameters_above_threshold',
+    'activation_level_threshold'
+])
+
+
+def _yaml():
+    # Imported on first use, so that importing the package does not
+    # load yaml
+    import yaml
+    return yaml
 
 
-@autoinitialized
+# The configuration file is parsed on first use rather than on import, so
+# that tools importing the package do not touch the filesystem
 class Config(metaclass=ConfigMeta):
     __configuration_changed_callbacks = []
     __config_file_location = None
+    # (modification time, size) of the file when it was last read
+    __file_signature = None
+    __client_settings = None
     _settings = {}
 
     @classmethod
@@ -27,14 +45,40 @@ class Config(metaclass=ConfigMeta):
         for callback in cls.__configuration_changed_callbacks:
             callback()
 
+    @classmethod
+    def __config_file_path(cls) -> str:
+        return os.path.join(cls.__config_file_location, 'vsn_config.yml')
+
+    @classmethod
+    def __file_signature_of(cls, path: str):
+        status = os.stat(path)
+        return status.st_mtime_ns, status.st_size
+
+    @classmethod
+    def __read(cls, path: str):
+        # The signature is taken before reading, so that a write in between
+        # triggers another reload
+        signature = cls.__file_signature_of(path)
+        with open(path) as stream:
+            return _yaml().safe_load(stream), signature
+
+    @classmethod
+    def _loaded_settings(cls) -> dict:
+        if cls.__config_file_location is None:
+            cls.initialize()
+        return cls._settings
+
     @classmethod
     def initialize(cls):
         for loc in (os.pardir, os.path.expanduser('~/.config/vsn_client'),
                     '/etc/vsn_client'):
+            path = os.path.join(loc, 'vsn_config.yml')
             try:
-                with open(os.path.join(loc, 'vsn_config.yml')) as stream:
-                    for key, value in yaml.load(stream).items():
-                        cls._settings[key] = value
+                settings, cls.__file_signature = cls.__read(path)
+                if not isinstance(settings, dict):
+                    sys.exit('Configuration file %s is empty or not a '
+                             'mapping' % path)
+                cls._settings.update(settings)
 
                 cls.__config_file_location = loc
                 return
@@ -42,6 +86,55 @@ class Config(metaclass=ConfigMeta):
                 pass
         sys.exit('Could not find configuration file')
 
+    @classmethod
+    def reload_if_changed(cls) -> bool:
+        # Cheap enough to be polled: the file is parsed only when it was
+        # modified and the callbacks run only when a setting changed. Only
+        # the reference server polls it, the nodes get the changes from the
+        # configuration packets it pushes.
+        if cls.__config_file_location is None:
+            cls.initialize()
+            return False
+
+        yaml = _yaml()
+        path = cls.__config_file_path()
+        try:
+            if cls.__file_signature_of(path) == cls.__file_signature:
+                return False
+            settings, cls.__file_signature = cls.__read(path)
+        except (OSError, yaml.YAMLError) as e:
+            logging.warning('Could not reload the configuration: %s', e)
+            return False
+
+        if not isinstance(settings, dict) or settings == cls._settings:
+            return False
+        # Updated in place, so that the settings dictionary stays shared
+        cls._settings.clear()
+        cls._settings.update(settings)
+        cls.__client_settings = None
+        logging.info('Configuration reloaded from %s', path)
+        cls.__execute_callbacks()
+        return True
+
+    @classmethod
+    def client_settings(cls) -> ClientSettingsTuple:
+        if cls.__client_settings is None:
+            clients = cls['clients']
+            cls.__client_settings = ClientSettingsTuple(
+                clients['hostname_based_ids'],
+                ImageSizeTuple(clients['image_size']['width'],
+                               clients['image_size']['height']),
+                clients['frame_rate'],
+                GainSampletimeTuple(
+                    clients['parameters_below_threshold']['gain'],
+                    clients['parameters_below_threshold']['sample_time']),
+                GainSampletimeTuple(
+                    clients['parameters_above_threshold']['gain'],
+                    clients['parameters_above_threshold']['sample_time']),
+                clients['activation_level_threshold']
+            )
+        return cls.__client_settings
+
     @classmethod
     def set_settings(cls, gain_below_threshold: float,
                      sample_time_below_threshold: float,
@@ -62,28 +155,46 @@ class Config(metaclass=ConfigMeta):
             for neighbour_id, dependency_value in dependencies.items():
                 cls['dependencies'][camera_id][neighbour_id] = dependency_value
 
+        cls.__client_settings = None
         cls.__execute_callbacks()
 
     @classmethod
     def add_configuration_changed_callback(cls, func: callable([])):
         cls.__configuration_changed_callbacks.append(func)
 
+    @classmethod
+    def remove_configuration_changed_callback(cls, func: callable([])):
+        cls.__configuration_changed_callbacks.remove(func)
+
     @classmethod
     def save_settings(cls):
+        # The file is rewritten from the settings, so its comments are lost
+        path = cls.__config_file_path()
+        # A crash while writing must not leave a truncated file behind
+        temporary_path = path + '.tmp'
+        yaml = _yaml()
         try:
-            with open(os.path.join(cls.__config_file_location,
-                                   'vsn_config.yml'), 'w') as stream:
-                yaml.dump(cls._settings, stream)
-        except Exception as e:
-            print(type(e))
-            print(e)
+            with open(temporary_path, 'w') as stream:
+                yaml.safe_dump(cls._loaded_settings(), stream,
+                               default_flow_style=False)
+            os.replace(temporary_path, path)
+            # The saved settings are the current ones, no reload needed
+            cls.__file_signature = cls.__file_signature_of(path)
+        except (OSError, yaml.YAMLError) as e:
+            logging.error('Could not save the configuration: %s', e)
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
 
     @classmethod
     def get_dependency_value(cls, camera_id: int, neighbour_id: int) -> float:
-        return cls._settings['dependencies'][camera_id][neighbour_id - 1]
+        return cls['dependencies'][camera_id][neighbour_id - 1]
 
 
-GainSampletimeTuple = namedtuple('GainSampletimeTuple', ['gain', 'sample_time'])
+# A grabbed image with the time.monotonic() of its capture, its number among
+# the frames captured by the camera and a description of the camera
+Frame = namedtuple('Frame', ['image', 'timestamp', 'sequence', 'source'])
 
 
 class ImageType(Enum):
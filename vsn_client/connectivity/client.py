@@ -1,24 +1,86 @@
 import logging
 
-from vsn_client.connectivity import client_base
+from vsn_client.common.packet import DisconnectPacket
+from vsn_client.connectivity import client_base, protocol
+from vsn_client.connectivity.datagram import DatagramEndpoint
 
 
 class VSNClient(client_base.TCPClient):
-    def __init__(self, server_address: str, server_port: int, packet_router):
+    def __init__(self, server_address: str, server_port: int, packet_router,
+                 server_locator: callable([])=None,
+                 connection_made_callback: callable([str])=None,
+                 **kwargs):
         self.__packet_router = packet_router
+        self.__server_locator = server_locator
+        self.__connection_made_callback = connection_made_callback
+        self.__datagram_endpoint = None
+        self.__datagram_task = None
 
-        super().__init__(server_address, server_port)
+        super().__init__(server_address, server_port, **kwargs)
+
+    def locate_server(self):
+        if self.__server_locator is None:
+            return super().locate_server()
+        return self.__server_locator()
+
+    def open_datagram_endpoint(self, node_id: int, port: int,
+                               answer_timeout: float=5.0,
+                               probe_interval: float=5.0):
+        # Data packets keep going over the stream until the endpoint is open
+        # and the server answered a datagram
+        self.__close_datagram_endpoint()
+        self.__datagram_task = self._loop.create_task(
+            self.__open_datagram_endpoint(node_id, port, answer_timeout,
+                                          probe_interval))
+
+    async def __open_datagram_endpoint(self, node_id: int, port: int,
+                                       answer_timeout: float,
+                                       probe_interval: float):
+        try:
+            transport, self.__datagram_endpoint = \
+                await self._loop.create_datagram_endpoint(
+                    lambda: DatagramEndpoint(node_id, self.data_received,
+                                             answer_timeout, probe_interval,
+                                             self.protocol_version),
+                    remote_addr=(self.server_address, port))
+        except OSError as e:
+            logging.error('Could not open datagram endpoint: %s', e)
+
+    def __close_datagram_endpoint(self):
+        if self.__datagram_task is not None:
+            self.__datagram_task.cancel()
+            self.__datagram_task = None
+        if self.__datagram_endpoint is not None:
+            self.__datagram_endpoint.close()
+            self.__datagram_endpoint = None
+
+    def send(self, object_to_send: object):
+        if self.__datagram_endpoint is not None and \
+                protocol.fits_datagram(object_to_send) and \
+                self.__datagram_endpoint.is_usable():
+            self.__datagram_endpoint.send(object_to_send)
+        else:
+            super().send(object_to_send)
 
     def connection_made(self):
         logging.info('Connection made')
+        # The server may have moved, the endpoint is opened again after the
+        # handshake
+        self.__close_datagram_endpoint()
+        if self.__connection_made_callback is not None:
+            self.__connection_made_callback(self.server_address)
 
     def connection_lost(self, deliberate: bool):
-        if not deliberate:
-            logging.error('Connection lost')
-        else:
+        # Until the next handshake the data packets wait in the send queue
+        self.__close_datagram_endpoint()
+        if deliberate:
             logging.info('Disconnected')
-
-        self._loop.stop()
+        elif self.reconnect:
+            logging.error('Connection lost - reconnecting')
+        else:
+            logging.error('Connection lost')
+            # Shut down as if the server asked for it
+            self.__packet_router.route_packet(DisconnectPacket())
 
     def data_received(self, received_object: object):
         logging.debug('Data received')
@@ -1,16 +1,88 @@
 import asyncio
-import pickle
+import collections
+import logging
+import random
 
 from abc import ABCMeta, abstractmethod
 
+from vsn_client.common import metrics
+from vsn_client.common.packet import ConfigurationPacketToClient, \
+    DataPacketToServer
+from vsn_client.connectivity import protocol
+
+
+def _coalesce(older: DataPacketToServer, newer: DataPacketToServer):
+    # The newer packet supersedes the older one, except for what it does not
+    # carry itself: the image regions of the newer packet are patches onto
+    # the image the server built from the older ones, so the whole image and
+    # the patches of the older packet must still reach the server, in order
+    if newer.image is None:
+        newer.image = older.image
+        if older.image_regions:
+            newer.image_regions = older.image_regions + \
+                (newer.image_regions or [])
+    if newer.metrics is None:
+        newer.metrics = older.metrics
+    return newer
+
 
 class TCPClient(metaclass=ABCMeta):
-    def __init__(self, server_address: str, server_port: int):
+    def __init__(self, server_address: str, server_port: int,
+                 protocol_version: int=protocol.LEGACY_PROTOCOL_VERSION,
+                 queue_size: int=16, coalesce: bool=False,
+                 reconnect: bool=False, reconnect_delay: float=1.0,
+                 max_reconnect_delay: float=30.0):
         self.__reader, self.__writer = None, None
+        self.__server_address = server_address
+        self.__server_port = server_port
+        # Start with the framing every server understands and upgrade once
+        # the server answers in the binary one
+        self.__initial_protocol_version = protocol_version
+        self.__protocol_version = protocol_version
+
+        # Data packets are dropped oldest first when the server cannot keep
+        # up, the other packets are never dropped
+        self.__queue_size = queue_size
+        self.__coalesce = coalesce
+        self.__control_packets = collections.deque()
+        self.__data_packets = collections.deque()
+        self.__packets_pending = asyncio.Event()
+        # Data packets wait on every new connection until the configuration
+        # of the server was handled, i.e. the node answered it with its own
+        self.__data_held = True
+
+        self.__reconnect = reconnect
+        self.__reconnect_delay = reconnect_delay
+        self.__max_reconnect_delay = max_reconnect_delay
+
+        self.__packets_sent = metrics.registry.counter(
+            'vsn_packets_sent_total', 'Packets written to the server')
+        self.__bytes_sent = metrics.registry.counter(
+            'vsn_bytes_sent_total', 'Bytes written to the server')
+        self.__packets_received = metrics.registry.counter(
+            'vsn_packets_received_total', 'Packets received from the server')
+        self.__connection_losses = metrics.registry.counter(
+            'vsn_connection_losses_total', 'Connections lost unexpectedly')
+        self.__reconnections = metrics.registry.counter(
+            'vsn_reconnections_total', 'Connections made again after a loss')
+        self.__pending_packets = metrics.registry.gauge(
+            'vsn_pending_packets', 'Packets waiting to be written')
+        self.__dropped_packets = metrics.registry.counter(
+            'vsn_dropped_packets_total',
+            'Data packets dropped because the send queue was full')
+        self.__coalesced_packets = metrics.registry.counter(
+            'vsn_coalesced_packets_total',
+            'Data packets superseded by a newer one before being written')
+
         self._loop = asyncio.get_event_loop()
-        self._loop.run_until_complete(self.__connect(server_address,
-                                                     server_port))
-        self.__listening_task = self._loop.create_task(self.__receive())
+        if reconnect:
+            self._loop.run_until_complete(self.__reconnect_with_backoff(
+                server_address))
+        else:
+            self._loop.run_until_complete(self.__connect(server_address,
+                                                         server_port))
+        self.__connection_task = self._loop.create_task(
+            self.__maintain_connection())
 
     def __del__(self):
         if self.__writer is not None:
@@ -18,40 +90,161 @@ class TCPClient(metaclass=ABCMeta):
 
     async def __connect(self, address: str, port: int):
         self.__reader, self.__writer = await asyncio.open_connection(
-            address, port, loop=self._loop)
+            address, port)
+        self.__server_address = address
+        # The server may have been replaced by an older one
+        self.__protocol_version = self.__initial_protocol_version
+        self.__data_held = True
         self.connection_made()
 
-    async def __send(self, obj: object):
-        encoded_data = pickle.dumps(obj)
-        self.__writer.write(len(encoded_data).to_bytes(4, byteorder='big') +
-                            encoded_data)
+    async def __reconnect_with_backoff(self, address: str=None):
+        # Tries the given address first, then whatever locate_server finds.
+        # When it finds nothing, e.g. multicast is blocked, the last known
+        # address is tried again.
+        delay = self.__reconnect_delay
+        while True:
+            if address is None:
+                address = await self._loop.run_in_executor(
+                    None, self.locate_server) or self.__server_address
+
+            if address is None:
+                logging.warning('Server not found')
+            else:
+                try:
+                    await self.__connect(address, self.__server_port)
+                    return
+                except OSError as e:
+                    logging.warning('Could not connect to %s: %s', address, e)
+
+            address = None
+            # Jitter keeps the nodes from reconnecting all at once after the
+            # server restarts
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, self.__max_reconnect_delay)
+
+    async def __maintain_connection(self):
+        try:
+            while True:
+                sending_task = self._loop.create_task(self.__send_pending())
+                try:
+                    await self.__receive()
+                finally:
+                    sending_task.cancel()
+                    self.__writer.close()
+
+                self.__connection_losses.inc()
+                self.connection_lost(deliberate=False)
+                if not self.__reconnect:
+                    return
+
+                await self.__reconnect_with_backoff(self.__server_address)
+                self.__reconnections.inc()
+        except asyncio.CancelledError:
+            self.connection_lost(deliberate=True)
+
+    def __next_packet(self) -> object:
+        if self.__control_packets:
+            return self.__control_packets.popleft()
+
+        packet = self.__data_packets.popleft()
+        if self.__coalesce:
+            while self.__data_packets:
+                packet = _coalesce(packet, self.__data_packets.popleft())
+                self.__coalesced_packets.inc()
+        return packet
 
+    async def __send_pending(self):
         try:
-            await self.__writer.drain()
-        except (ConnectionResetError, BrokenPipeError):
-            self.connection_lost(deliberate=False)
+            while True:
+                await self.__packets_pending.wait()
+                self.__packets_pending.clear()
+
+                while self.__control_packets or (
+                        self.__data_packets and not self.__data_held):
+                    packet = self.__next_packet()
+                    self.__pending_packets.set(len(self.__control_packets) +
+                                               len(self.__data_packets))
+
+                    buffers = protocol.encode(packet, self.__protocol_version)
+                    self.__writer.writelines(buffers)
+                    self.__packets_sent.inc()
+                    self.__bytes_sent.inc(sum(memoryview(b).nbytes
+                                              for b in buffers))
+                    await self.__writer.drain()
+        except ConnectionError as e:
+            # Closing makes the receiving side notice the loss
+            logging.debug('Sending failed: %s', e)
+            self.__writer.close()
 
     async def __receive(self):
+        # Returns once the connection is broken
         try:
             while True:
-                encoded_length = await self.__reader.readexactly(4)
-                length = int.from_bytes(encoded_length, byteorder='big')
+                encoded_length = await self.__reader.readexactly(
+                    protocol.LENGTH_SIZE)
+                length = protocol.decode_length(encoded_length)
 
-                pickled_obj = await self.__reader.readexactly(length)
-                obj = pickle.loads(pickled_obj)
+                payload = await self.__reader.readexactly(length)
+                legacy = self.__protocol_version == \
+                    protocol.LEGACY_PROTOCOL_VERSION
+                obj = protocol.decode(payload, allow_legacy=legacy)
+                if legacy and not protocol.is_legacy(payload):
+                    # The version announced by the server, if newer ones
+                    # are understood too
+                    self.__protocol_version = min(
+                        protocol.PROTOCOL_VERSION,
+                        getattr(obj, 'protocol_version', None) or
+                        protocol.PROTOCOL_VERSION)
+                    logging.info('Server switched to protocol version %d',
+                                 self.__protocol_version)
+                self.__packets_received.inc()
                 self.data_received(obj)
-        except (asyncio.streams.IncompleteReadError,
-                ConnectionResetError, BrokenPipeError):
-            self.connection_lost(deliberate=False)
-        except asyncio.CancelledError:
-            self.connection_lost(deliberate=True)
+                if self.__data_held and \
+                        isinstance(obj, ConfigurationPacketToClient):
+                    # Whatever the node answers is queued ahead of the data
+                    self.__data_held = False
+                    self.__packets_pending.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except protocol.ProtocolError as e:
+            logging.error('Protocol error: %s', e)
+
+    @property
+    def server_address(self) -> str:
+        return self.__server_address
+
+    @property
+    def protocol_version(self) -> int:
+        return self.__protocol_version
+
+    @property
+    def reconnect(self) -> bool:
+        return self.__reconnect
+
+    def locate_server(self) -> str:
+        # Called off the event loop before every reconnection attempt,
+        # returns the server address or None when it is not known
+        return self.__server_address
 
     def send(self, object_to_send: object):
-        self._loop.create_task(self.__send(object_to_send))
+        if isinstance(object_to_send, DataPacketToServer):
+            if len(self.__data_packets) >= self.__queue_size:
+                dropped = self.__data_packets.popleft()
+                following = self.__data_packets[0] if self.__data_packets \
+                    else object_to_send
+                _coalesce(dropped, following)
+                self.__dropped_packets.inc()
+            self.__data_packets.append(object_to_send)
+        else:
+            self.__control_packets.append(object_to_send)
+
+        self.__pending_packets.set(len(self.__control_packets) +
+                                   len(self.__data_packets))
+        self.__packets_pending.set()
 
     def disconnect(self):
         self.__writer.close()
-        self.__listening_task.cancel()
+        self.__connection_task.cancel()
 
     @abstractmethod
     def connection_made(self):
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+
+from vsn_client.common import metrics
+from vsn_client.connectivity import protocol
+
+
+class DatagramEndpoint(asyncio.DatagramProtocol):
+    # Data packets of one node over UDP. Lost datagrams are not resent and
+    # those arriving after a newer one are discarded, since only the latest
+    # activation matters. The server may not listen or UDP may be blocked,
+    # so the endpoint is used only once a datagram of the server arrived;
+    # until then one probe per probe_interval goes this way. It is given up
+    # again on ICMP errors or when no answers arrive for answer_timeout.
+    # Packets are encoded for the protocol version negotiated on the stream.
+    def __init__(self, node_id: int, packet_callback: callable([object]),
+                 answer_timeout: float=5.0, probe_interval: float=5.0,
+                 protocol_version: int=protocol.PROTOCOL_VERSION):
+        self.__node_id = node_id
+        self.__packet_callback = packet_callback
+        self.__protocol_version = protocol_version
+        self.__answer_timeout = answer_timeout
+        self.__probe_interval = probe_interval
+        self.__transport = None
+        self.__sequence = 0
+        self.__last_received_sequence = None
+        self.__confirmed = False
+        self.__unanswered_since = None
+        self.__last_probe_time = None
+
+        self.__datagrams_sent = metrics.registry.counter(
+            'vsn_datagrams_sent_total', 'Data packets sent as datagrams')
+        self.__datagrams_received = metrics.registry.counter(
+            'vsn_datagrams_received_total',
+            'Data packets received as datagrams')
+        self.__stale_datagrams = metrics.registry.counter(
+            'vsn_stale_datagrams_total',
+            'Datagrams discarded because a newer one arrived first')
+        self.__fallbacks = metrics.registry.counter(
+            'vsn_datagram_fallbacks_total',
+            'Times the data packets went back to the stream')
+
+    def connection_made(self, transport):
+        self.__transport = transport
+
+    def datagram_received(self, data, address):
+        try:
+            node_id, sequence, packet = protocol.decode_datagram(data)
+        except protocol.ProtocolError as e:
+            logging.warning('Invalid datagram from %s: %s', address, e)
+            return
+
+        if self.__last_received_sequence is not None and \
+                not protocol.is_newer_sequence(
+                    sequence, self.__last_received_sequence):
+            self.__stale_datagrams.inc()
+            return
+
+        self.__last_received_sequence = sequence
+        self.__datagrams_received.inc()
+        self.__unanswered_since = None
+        if not self.__confirmed:
+            logging.info('Datagrams answered, sending data packets as '
+                         'datagrams')
+            self.__confirmed = True
+        self.__packet_callback(packet)
+
+    def error_received(self, exc):
+        # E.g. the server port is not open, the stream still works
+        logging.debug('Datagram error: %s', exc)
+        self.__fall_back(str(exc))
+
+    def __fall_back(self, reason: str):
+        if self.__confirmed:
+            logging.warning('Sending data packets over the stream again: %s',
+                            reason)
+            self.__fallbacks.inc()
+        self.__confirmed = False
+        self.__unanswered_since = None
+        self.__last_probe_time = time.monotonic()
+
+    def is_usable(self) -> bool:
+        # Whether the next data packet should be sent as a datagram
+        current_time = time.monotonic()
+        if self.__confirmed:
+            if self.__unanswered_since is None or \
+                    current_time - self.__unanswered_since < \
+                    self.__answer_timeout:
+                return True
+            self.__fall_back('no answers for %.1f s' % (
+                current_time - self.__unanswered_since))
+            return False
+
+        if self.__last_probe_time is not None and \
+                current_time - self.__last_probe_time < self.__probe_interval:
+            return False
+        self.__last_probe_time = current_time
+        return True
+
+    def send(self, packet: object):
+        self.__sequence = protocol.next_sequence(self.__sequence)
+        self.__transport.sendto(protocol.encode_datagram(
+            packet, self.__node_id, self.__sequence, self.__protocol_version))
+        self.__datagrams_sent.inc()
+        if self.__unanswered_since is None:
+            self.__unanswered_since = time.monotonic()
+
+    def close(self):
+        if self.__transport is not None:
+            self.__transport.close()
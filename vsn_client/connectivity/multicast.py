@@ -1,14 +1,204 @@
+import asyncio
+import ipaddress
+import logging
+import os
 import socket
+import struct
+import time
+
+DISCOVERY_PORT = 54545
+# Announcements are the server address, optionally followed by other fields
+_MAXIMUM_ANNOUNCEMENT_SIZE = 1024
+# Latency probes are echoed on the discovery port with the answer prefix,
+# followed by the nonce of the probe
+_PROBE = b'VSN-PROBE '
+_PROBE_ANSWER = b'VSN-PROBE-ANSWER '
+_NONCE_SIZE = 8
+
+
+def _normalized_address(address: str):
+    # Drop the scope of link-local addresses and unwrap IPv4 addresses
+    # received on a dual-stack socket
+    address = ipaddress.ip_address(address.split('%')[0])
+    if address.version == 6 and address.ipv4_mapped is not None:
+        return address.ipv4_mapped
+    return address
 
 
 class Client:
-    def __init__(self):
-        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def __init__(self, port: int=DISCOVERY_PORT, group: str=None,
+                 ipv6: bool=False):
+        family = socket.AF_INET6 if ipv6 else socket.AF_INET
+        self.__socket = socket.socket(family, socket.SOCK_DGRAM)
         self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.__socket.bind(('', 54545))
+        if ipv6:
+            # Listen to IPv4 announcements as well
+            self.__socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY,
+                                     0)
+        self.__socket.bind(('::' if ipv6 else '', port))
+
+        if group is not None:
+            group_address = socket.inet_pton(family, group)
+            if ipv6:
+                self.__socket.setsockopt(
+                    socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP,
+                    group_address + struct.pack('@I', 0))
+            else:
+                self.__socket.setsockopt(
+                    socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                    group_address + socket.inet_aton('0.0.0.0'))
+
+    def __receive_announcement(self, deadline: float):
+        # Returns the announced address, or None once the deadline passed
+        while True:
+            remaining = None if deadline is None else \
+                deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+
+            self.__socket.settimeout(remaining)
+            try:
+                data, sender = self.__socket.recvfrom(
+                    _MAXIMUM_ANNOUNCEMENT_SIZE)
+            except socket.timeout:
+                return None
+
+            try:
+                address = data.decode('utf8').split()[0]
+                if _normalized_address(address) == \
+                        _normalized_address(sender[0]):
+                    return address
+                logging.debug('Ignoring announcement of %s sent by %s',
+                              address, sender[0])
+            except (UnicodeDecodeError, IndexError, ValueError):
+                logging.debug('Ignoring malformed announcement from %s',
+                              sender[0])
+
+    def receive_ip(self, timeout: float=None):
+        return self.__receive_announcement(
+            None if timeout is None else time.monotonic() + timeout)
+
+    def receive_ips(self, timeout: float=None, window: float=0.5) -> list:
+        # Every server announcing itself within the window after the first
+        first_address = self.receive_ip(timeout)
+        if first_address is None:
+            return []
+
+        addresses = [first_address]
+        deadline = time.monotonic() + window
+        while True:
+            address = self.__receive_announcement(deadline)
+            if address is None:
+                return addresses
+            if address not in addresses:
+                addresses.append(address)
+
+
+class LatencyProbeResponder(asyncio.DatagramProtocol):
+    # Run by servers on the discovery port, next to their announcements, to
+    # answer the latency probes of the nodes
+    def __init__(self):
+        self.__transport = None
+
+    def connection_made(self, transport):
+        self.__transport = transport
+
+    def datagram_received(self, data, address):
+        if data.startswith(_PROBE) and \
+                len(data) == len(_PROBE) + _NONCE_SIZE:
+            self.__transport.sendto(_PROBE_ANSWER + data[len(_PROBE):],
+                                    address)
+
+
+def measure_latency(address: str, port: int=DISCOVERY_PORT,
+                    timeout: float=1.0):
+    # Round trip of a probe datagram echoed on the discovery port, or None
+    # when the server does not answer. The data port is never touched, a
+    # connection there would register a node.
+    nonce = os.urandom(_NONCE_SIZE)
+    try:
+        family, _, _, _, server_address = socket.getaddrinfo(
+            address, port, type=socket.SOCK_DGRAM)[0]
+        with socket.socket(family, socket.SOCK_DGRAM) as probe_socket:
+            time_start = time.perf_counter()
+            probe_socket.sendto(_PROBE + nonce, server_address)
+            while True:
+                remaining = time_start + timeout - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                probe_socket.settimeout(remaining)
+                data, sender = probe_socket.recvfrom(len(_PROBE_ANSWER) +
+                                                     _NONCE_SIZE)
+                if data == _PROBE_ANSWER + nonce:
+                    return time.perf_counter() - time_start
+    except OSError:
+        return None
+
+
+def select_server(addresses: list, port: int=DISCOVERY_PORT,
+                  timeout: float=1.0):
+    if len(addresses) == 1:
+        return addresses[0]
+
+    latencies = [(latency, address) for latency, address in
+                 ((measure_latency(address, port, timeout), address)
+                  for address in addresses)
+                 if latency is not None]
+    if not latencies:
+        # Servers not answering probes, the first one to announce itself
+        logging.info('Selected server %s out of %d, none answered probes',
+                     addresses[0], len(addresses))
+        return addresses[0]
+    latency, address = min(latencies)
+    logging.info('Selected server %s out of %d, %.2f ms away', address,
+                 len(addresses), latency * 1000)
+    return address
+
+
+class VSNServerDiscovery:
+    def __init__(self, port: int=DISCOVERY_PORT, group: str=None,
+                 ipv6: bool=False, timeout: float=5.0, retries: int=3,
+                 window: float=0.5, cache_path: str=None):
+        self.__port = port
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__window = window
+        self.__cache_path = os.path.expanduser(cache_path) \
+            if cache_path is not None else None
+        self.__client = Client(port, group, ipv6)
+
+    def cached_address(self):
+        if self.__cache_path is None:
+            return None
+        try:
+            with open(self.__cache_path) as stream:
+                return stream.read().strip() or None
+        except OSError:
+            return None
+
+    def is_reachable(self, address: str) -> bool:
+        return measure_latency(address, self.__port) is not None
+
+    def remember(self, address: str):
+        if self.__cache_path is None or address == self.cached_address():
+            return
+        try:
+            os.makedirs(os.path.dirname(self.__cache_path), exist_ok=True)
+            # Never leave a truncated file behind after a power cut
+            temporary_path = self.__cache_path + '.tmp'
+            with open(temporary_path, 'w') as stream:
+                stream.write(address)
+            os.replace(temporary_path, self.__cache_path)
+        except OSError as e:
+            logging.warning('Could not cache the server address: %s', e)
 
-    def receive_ip(self):
-        address, address_port_tuple = self.__socket.recvfrom(15)
-        address = address.decode('utf8')
-        if address == address_port_tuple[0]:
-            return address
+    def locate(self):
+        # Returns the selected server address, or None after all retries
+        for attempt in range(self.__retries):
+            addresses = self.__client.receive_ips(self.__timeout,
+                                                  self.__window)
+            if addresses:
+                return select_server(addresses, self.__port)
+            logging.warning('No server found (attempt %d of %d)',
+                            attempt + 1, self.__retries)
+        return None
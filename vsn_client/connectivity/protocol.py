@@ -0,0 +1,430 @@
+import copy
+import pickle
+import struct
+
+from vsn_client.common.packet import ConfigurationPacketToClient, \
+    ConfigurationPacketToServer, DataPacketToServer, DataPacketToClient, \
+    DisconnectPacket
+from vsn_client.common.utility import ImageType
+
+# Version 0 is the legacy framing with pickled packets. Both sides start with
+# it, the client advertises its version in ConfigurationPacketToServer and the
+# server switches to the binary framing by answering with a binary packet.
+LEGACY_PROTOCOL_VERSION = 0
+# Version 1 is the binary framing with the optional tiles, metrics and image
+# regions of the data packets. They were added while version 1 was in
+# development; peers built with only some of them are not supported.
+# Version 2 adds the capture time and frame number to the data packets
+PROTOCOL_VERSION = 2
+
+# Every pickle protocol >= 2 starts with the PROTO opcode, which never
+# collides with the type tags below
+_PICKLE_PROTO = 0x80
+
+_TAG_CONFIGURATION_TO_CLIENT = 1
+_TAG_CONFIGURATION_TO_SERVER = 2
+_TAG_DATA_TO_SERVER = 3
+_TAG_DATA_TO_CLIENT = 4
+_TAG_DISCONNECT = 5
+
+_LENGTH = struct.Struct('>I')
+_TAG = struct.Struct('>B')
+_HEADER = struct.Struct('>IB')
+
+LENGTH_SIZE = _LENGTH.size
+
+_CONFIGURATION_TO_CLIENT = struct.Struct('>BBi2sHHdddddd')
+_CONFIGURATION_TO_SERVER = struct.Struct('>iB')
+_DATA_TO_SERVER = struct.Struct('>Bdddd')
+_DATA_TO_CLIENT = struct.Struct('>d')
+_SERVER_TIME = struct.Struct('>d')
+_TILE_GRID = struct.Struct('>BB')
+_METRICS_COUNT = struct.Struct('>H')
+_METRIC_NAME_LENGTH = struct.Struct('>B')
+_METRIC_VALUE = struct.Struct('>d')
+_REGIONS_COUNT = struct.Struct('>B')
+_REGION = struct.Struct('>HHI')
+_FRAME = struct.Struct('>dQ')
+_DATAGRAM_HEADER = struct.Struct('>BiI')
+
+# Sequence numbers of datagrams wrap around at 32 bits
+_SEQUENCE_MODULO = 1 << 32
+
+_NODE_ID_PRESENT = 0x01
+_SEND_IMAGE_PRESENT = 0x02
+_SEND_IMAGE = 0x04
+_IMAGE_TYPE_PRESENT = 0x08
+_HOSTNAME_BASED_IDS = 0x10
+_PKGS_TO_UPDATE_PRESENT = 0x20
+_SERVER_TIME_PRESENT = 0x40
+
+_IMAGE_PRESENT = 0x01
+_TILES_PRESENT = 0x02
+_METRICS_PRESENT = 0x04
+_IMAGE_REGIONS_PRESENT = 0x08
+_FRAME_PRESENT = 0x10
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _encode_configuration_to_client(packet: ConfigurationPacketToClient):
+    flags = 0
+    if packet.node_id is not None:
+        flags |= _NODE_ID_PRESENT
+    if packet.send_image is not None:
+        flags |= _SEND_IMAGE_PRESENT
+        if packet.send_image:
+            flags |= _SEND_IMAGE
+    if packet.image_type is not None:
+        flags |= _IMAGE_TYPE_PRESENT
+    if packet.hostname_based_ids:
+        flags |= _HOSTNAME_BASED_IDS
+    if packet.pkgs_to_update is not None:
+        flags |= _PKGS_TO_UPDATE_PRESENT
+    if packet.server_time is not None:
+        flags |= _SERVER_TIME_PRESENT
+
+    image_type = b'' if packet.image_type is None \
+        else packet.image_type.value.encode('ascii')
+
+    fields = _CONFIGURATION_TO_CLIENT.pack(
+        PROTOCOL_VERSION if packet.protocol_version is None
+        else packet.protocol_version,
+        flags,
+        packet.node_id if packet.node_id is not None else 0,
+        image_type,
+        packet.image_size['width'],
+        packet.image_size['height'],
+        packet.frame_rate,
+        packet.parameters_below_threshold['gain'],
+        packet.parameters_below_threshold['sample_time'],
+        packet.parameters_above_threshold['gain'],
+        packet.parameters_above_threshold['sample_time'],
+        packet.activation_level_threshold
+    )
+
+    buffers = [fields]
+    if packet.server_time is not None:
+        buffers.append(_SERVER_TIME.pack(packet.server_time))
+    if packet.pkgs_to_update is not None:
+        buffers.append('\n'.join(packet.pkgs_to_update).encode('utf8'))
+    return buffers
+
+
+def _decode_configuration_to_client(payload: memoryview):
+    (protocol_version, flags, node_id, image_type, width, height, frame_rate,
+     gain_below_threshold, sample_time_below_threshold,
+     gain_above_threshold, sample_time_above_threshold,
+     activation_level_threshold) = _CONFIGURATION_TO_CLIENT.unpack_from(
+        payload)
+
+    # The constructor fills the fields from the local configuration, which is
+    # exactly what the packet is supposed to override
+    packet = ConfigurationPacketToClient.__new__(ConfigurationPacketToClient)
+    packet.node_id = node_id if flags & _NODE_ID_PRESENT else None
+    packet.send_image = bool(flags & _SEND_IMAGE) \
+        if flags & _SEND_IMAGE_PRESENT else None
+    packet.image_type = ImageType(image_type.decode('ascii')) \
+        if flags & _IMAGE_TYPE_PRESENT else None
+    packet.hostname_based_ids = bool(flags & _HOSTNAME_BASED_IDS)
+    packet.image_size = {'width': width, 'height': height}
+    packet.frame_rate = frame_rate
+    packet.parameters_below_threshold = {
+        'gain': gain_below_threshold,
+        'sample_time': sample_time_below_threshold
+    }
+    packet.parameters_above_threshold = {
+        'gain': gain_above_threshold,
+        'sample_time': sample_time_above_threshold
+    }
+    packet.activation_level_threshold = activation_level_threshold
+    packet.protocol_version = protocol_version
+    offset = _CONFIGURATION_TO_CLIENT.size
+
+    packet.server_time = None
+    if flags & _SERVER_TIME_PRESENT:
+        packet.server_time, = _SERVER_TIME.unpack_from(payload, offset)
+        offset += _SERVER_TIME.size
+
+    if flags & _PKGS_TO_UPDATE_PRESENT:
+        pkgs = bytes(payload[offset:]).decode('utf8')
+        packet.pkgs_to_update = pkgs.split('\n') if pkgs else []
+    else:
+        packet.pkgs_to_update = None
+
+    return packet
+
+
+def _encode_configuration_to_server(packet: ConfigurationPacketToServer):
+    return [
+        _CONFIGURATION_TO_SERVER.pack(
+            packet.node_id,
+            PROTOCOL_VERSION if packet.protocol_version is None
+            else packet.protocol_version
+        ),
+        packet.software_version.encode('utf8')
+    ]
+
+
+def _decode_configuration_to_server(payload: memoryview):
+    node_id, protocol_version = _CONFIGURATION_TO_SERVER.unpack_from(payload)
+    software_version = bytes(
+        payload[_CONFIGURATION_TO_SERVER.size:]).decode('utf8')
+    return ConfigurationPacketToServer(node_id, software_version,
+                                       protocol_version)
+
+
+def _encode_data_to_server(packet: DataPacketToServer):
+    flags = 0
+    if packet.image is not None:
+        flags |= _IMAGE_PRESENT
+    if packet.tiles is not None:
+        flags |= _TILES_PRESENT
+    if packet.metrics is not None:
+        flags |= _METRICS_PRESENT
+    if packet.image_regions is not None:
+        flags |= _IMAGE_REGIONS_PRESENT
+    if packet.frame_sequence is not None:
+        flags |= _FRAME_PRESENT
+
+    buffers = [_DATA_TO_SERVER.pack(
+        flags,
+        packet.white_pixels,
+        packet.activation_level,
+        packet.gain,
+        packet.sample_time
+    )]
+
+    if packet.frame_sequence is not None:
+        buffers.append(_FRAME.pack(packet.capture_time,
+                                   packet.frame_sequence))
+
+    if packet.tiles is not None:
+        rows, columns = len(packet.tiles), len(packet.tiles[0])
+        buffers.append(
+            _TILE_GRID.pack(rows, columns) +
+            struct.pack('>%df' % (rows * columns),
+                        *(value for row in packet.tiles for value in row))
+        )
+
+    if packet.metrics is not None:
+        encoded_metrics = [_METRICS_COUNT.pack(len(packet.metrics))]
+        for name, value in packet.metrics.items():
+            encoded_name = name.encode('utf8')
+            encoded_metrics.append(
+                _METRIC_NAME_LENGTH.pack(len(encoded_name)) + encoded_name +
+                _METRIC_VALUE.pack(value)
+            )
+        buffers.append(b''.join(encoded_metrics))
+
+    if packet.image_regions is not None:
+        # Region headers first, followed by the raw encoded regions
+        region_images = [memoryview(image).cast('B')
+                         for x, y, image in packet.image_regions]
+        buffers.append(_REGIONS_COUNT.pack(len(region_images)) + b''.join(
+            _REGION.pack(x, y, image.nbytes) for (x, y, _), image in
+            zip(packet.image_regions, region_images)
+        ))
+        buffers.extend(region_images)
+
+    if packet.image is not None:
+        # The image goes out as a raw trailing buffer, without being copied
+        buffers.append(memoryview(packet.image).cast('B'))
+
+    return buffers
+
+
+def _decode_data_to_server(payload: memoryview):
+    (flags, white_pixels, activation_level, gain,
+     sample_time) = _DATA_TO_SERVER.unpack_from(payload)
+    offset = _DATA_TO_SERVER.size
+
+    capture_time = frame_sequence = None
+    if flags & _FRAME_PRESENT:
+        capture_time, frame_sequence = _FRAME.unpack_from(payload, offset)
+        offset += _FRAME.size
+
+    tiles = None
+    if flags & _TILES_PRESENT:
+        rows, columns = _TILE_GRID.unpack_from(payload, offset)
+        offset += _TILE_GRID.size
+        values = struct.unpack_from('>%df' % (rows * columns), payload, offset)
+        offset += 4 * rows * columns
+        tiles = [list(values[row * columns:(row + 1) * columns])
+                 for row in range(rows)]
+
+    metrics = None
+    if flags & _METRICS_PRESENT:
+        metrics = {}
+        count, = _METRICS_COUNT.unpack_from(payload, offset)
+        offset += _METRICS_COUNT.size
+        for _ in range(count):
+            name_length, = _METRIC_NAME_LENGTH.unpack_from(payload, offset)
+            offset += _METRIC_NAME_LENGTH.size
+            name = bytes(payload[offset:offset + name_length]).decode('utf8')
+            offset += name_length
+            metrics[name], = _METRIC_VALUE.unpack_from(payload, offset)
+            offset += _METRIC_VALUE.size
+
+    image_regions = None
+    if flags & _IMAGE_REGIONS_PRESENT:
+        count, = _REGIONS_COUNT.unpack_from(payload, offset)
+        offset += _REGIONS_COUNT.size
+        headers = []
+        for _ in range(count):
+            headers.append(_REGION.unpack_from(payload, offset))
+            offset += _REGION.size
+        image_regions = []
+        for x, y, length in headers:
+            image_regions.append((x, y, bytes(payload[offset:offset + length])))
+            offset += length
+
+    image = None
+    if flags & _IMAGE_PRESENT:
+        image = bytes(payload[offset:])
+
+    return DataPacketToServer(white_pixels, activation_level, gain,
+                              sample_time, image, tiles, metrics,
+                              image_regions, capture_time, frame_sequence)
+
+
+def _encode_data_to_client(packet: DataPacketToClient):
+    return [_DATA_TO_CLIENT.pack(packet.activation_neighbours)]
+
+
+def _decode_data_to_client(payload: memoryview):
+    return DataPacketToClient(*_DATA_TO_CLIENT.unpack_from(payload))
+
+
+def _encode_disconnect(packet: DisconnectPacket):
+    return []
+
+
+def _decode_disconnect(payload: memoryview):
+    return DisconnectPacket()
+
+
+_encoders = {
+    ConfigurationPacketToClient: (_TAG_CONFIGURATION_TO_CLIENT,
+                                  _encode_configuration_to_client),
+    ConfigurationPacketToServer: (_TAG_CONFIGURATION_TO_SERVER,
+                                  _encode_configuration_to_server),
+    DataPacketToServer: (_TAG_DATA_TO_SERVER, _encode_data_to_server),
+    DataPacketToClient: (_TAG_DATA_TO_CLIENT, _encode_data_to_client),
+    DisconnectPacket: (_TAG_DISCONNECT, _encode_disconnect)
+}
+
+_decoders = {
+    _TAG_CONFIGURATION_TO_CLIENT: _decode_configuration_to_client,
+    _TAG_CONFIGURATION_TO_SERVER: _decode_configuration_to_server,
+    _TAG_DATA_TO_SERVER: _decode_data_to_server,
+    _TAG_DATA_TO_CLIENT: _decode_data_to_client,
+    _TAG_DISCONNECT: _decode_disconnect
+}
+
+
+def is_legacy(payload) -> bool:
+    return len(payload) > 0 and payload[0] == _PICKLE_PROTO
+
+
+def _downgraded(packet: object, protocol_version: int) -> object:
+    if protocol_version < 2 and isinstance(packet, DataPacketToServer) and \
+            packet.frame_sequence is not None:
+        # Decoders of version 1 would take the frame fields for the tiles
+        packet = copy.copy(packet)
+        packet.capture_time = packet.frame_sequence = None
+    return packet
+
+
+# Returns the length-prefixed frame as a list of buffers to be written one
+# after another, so that large payloads are never concatenated
+def encode(packet: object, protocol_version: int=PROTOCOL_VERSION) -> list:
+    if protocol_version == LEGACY_PROTOCOL_VERSION:
+        if isinstance(packet, DataPacketToServer):
+            # Views of the encoder output cannot be pickled
+            packet = copy.copy(packet)
+            if packet.image is not None:
+                packet.image = bytes(packet.image)
+            if packet.image_regions is not None:
+                packet.image_regions = [(x, y, bytes(image)) for x, y, image
+                                        in packet.image_regions]
+        encoded_data = pickle.dumps(packet)
+        return [_LENGTH.pack(len(encoded_data)), encoded_data]
+
+    try:
+        tag, encoder = _encoders[type(packet)]
+    except KeyError:
+        raise TypeError('Packet of unsupported type: %r' % type(packet))
+
+    buffers = encoder(_downgraded(packet, protocol_version))
+    length = _TAG.size + sum(memoryview(b).nbytes for b in buffers)
+    buffers.insert(0, _HEADER.pack(length, tag))
+    return buffers
+
+
+# Decodes a frame payload, i.e. everything after the length prefix
+def decode(payload, allow_legacy: bool=False) -> object:
+    if is_legacy(payload):
+        if not allow_legacy:
+            raise ProtocolError('Legacy pickled packet received after '
+                                'the binary protocol was negotiated')
+        return pickle.loads(payload)
+
+    payload = memoryview(payload)
+    try:
+        decoder = _decoders[payload[0]]
+    except (KeyError, IndexError):
+        raise ProtocolError('Packet with unknown type tag received')
+
+    try:
+        return decoder(payload[_TAG.size:])
+    except (struct.error, ValueError, UnicodeDecodeError) as e:
+        raise ProtocolError('Malformed packet received: %s' % e)
+
+
+def decode_length(encoded_length: bytes) -> int:
+    return _LENGTH.unpack(encoded_length)[0]
+
+
+# Only the fixed numeric fields of the data packets travel in datagrams,
+# anything larger or not to be lost goes over the stream
+def fits_datagram(packet: object) -> bool:
+    if isinstance(packet, DataPacketToServer):
+        return packet.image is None and packet.tiles is None and \
+            packet.metrics is None and packet.image_regions is None
+    return isinstance(packet, DataPacketToClient)
+
+
+def encode_datagram(packet: object, node_id: int, sequence: int,
+                    protocol_version: int=PROTOCOL_VERSION) -> bytes:
+    if not fits_datagram(packet):
+        raise TypeError('Packet does not fit a datagram: %r' % type(packet))
+
+    tag, encoder = _encoders[type(packet)]
+    return b''.join([_DATAGRAM_HEADER.pack(tag, node_id, sequence)] +
+                    encoder(_downgraded(packet, protocol_version)))
+
+
+# Returns the node id, the sequence number and the packet
+def decode_datagram(payload) -> tuple:
+    payload = memoryview(payload)
+    try:
+        tag, node_id, sequence = _DATAGRAM_HEADER.unpack_from(payload)
+        if tag not in (_TAG_DATA_TO_SERVER, _TAG_DATA_TO_CLIENT):
+            raise ProtocolError('Datagram with unexpected type tag received')
+        return node_id, sequence, _decoders[tag](
+            payload[_DATAGRAM_HEADER.size:])
+    except struct.error as e:
+        raise ProtocolError('Malformed datagram received: %s' % e)
+
+
+def next_sequence(sequence: int) -> int:
+    return (sequence + 1) % _SEQUENCE_MODULO
+
+
+def is_newer_sequence(sequence: int, last_sequence: int) -> bool:
+    # Serial number arithmetic, so that the order survives the wrap around
+    difference = (sequence - last_sequence) % _SEQUENCE_MODULO
+    return 0 < difference < _SEQUENCE_MODULO // 2
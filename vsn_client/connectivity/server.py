@@ -0,0 +1,263 @@
+import asyncio
+import collections
+import logging
+import time
+
+from vsn_client.common.packet import ConfigurationPacketToClient, \
+    DataPacketToClient, DisconnectPacket, ServerPacketRouter
+from vsn_client.common.utility import Config
+from vsn_client.connectivity import multicast, protocol
+
+
+class _Connection:
+    def __init__(self, node_id: int, writer):
+        self.node_id = node_id
+        self.writer = writer
+        self.activation_level = 0.0
+        # Known once the node sent a datagram. Answers go the way the packet
+        # they answer came, so a node whose datagrams are lost or blocked
+        # still gets those sent over the stream.
+        self.datagram_address = None
+        self.answer_by_datagram = False
+        self.datagram_sequence = 0
+        self.last_received_sequence = None
+        self.last_frame_sequence = None
+        # Seconds from the capture of the last frame to receiving its packet
+        self.capture_latency = None
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, datagram_callback: callable([bytes, tuple])):
+        self.__datagram_callback = datagram_callback
+
+    def datagram_received(self, data, address):
+        self.__datagram_callback(data, address)
+
+    def error_received(self, exc):
+        logging.debug('Datagram error: %s', exc)
+
+
+# Minimal server speaking the client protocol, for benchmarks and load tests.
+# Every client gets a node id and a configuration packet on connection, and
+# each data packet is answered with the neighbour activation computed from the
+# dependency table, like the real server does.
+class VSNReferenceServer:
+    def __init__(self, protocol_version: int=protocol.PROTOCOL_VERSION,
+                 send_image: bool=False, image_type=None,
+                 dependencies: dict=None, reload_interval: float=None,
+                 latency_samples: int=100000):
+        self.__protocol_version = protocol_version
+        self.__send_image = send_image
+        self.__image_type = image_type
+        # Row n holds the dependencies of node n on nodes 1, 2, ...; None
+        # follows the configuration, reloaded every reload_interval seconds
+        self.__dependencies = dependencies
+        self.__reload_interval = reload_interval
+        self.__reload_task = None
+        self.__router = ServerPacketRouter(self.__process_data_packet,
+                                           self.__process_configuration_packet)
+        self.__connections = {}
+        self.__next_node_id = 1
+        self.__server = None
+        self.__datagram_transport = None
+        self.__probe_transport = None
+        self.__packet_waiters = {}
+
+        self.packets_received = 0
+        self.bytes_received = 0
+        self.packets_sent = 0
+        self.datagrams_received = 0
+        self.stale_datagrams = 0
+        self.stale_frames = 0
+        # The most recent ones only, so that long runs do not grow without
+        # bound
+        self.capture_latencies = collections.deque(maxlen=latency_samples)
+
+    @property
+    def port(self) -> int:
+        return self.__server.sockets[0].getsockname()[1]
+
+    @property
+    def connected_clients(self) -> int:
+        return len(self.__connections)
+
+    @property
+    def datagram_port(self) -> int:
+        return self.__datagram_transport.get_extra_info('sockname')[1]
+
+    async def start(self, host: str='127.0.0.1', port: int=0,
+                    datagram_port: int=None, probe_port: int=None):
+        self.__server = await asyncio.start_server(self.__handle_connection,
+                                                   host, port)
+        if datagram_port is not None:
+            self.__datagram_transport, _ = \
+                await asyncio.get_event_loop().create_datagram_endpoint(
+                    lambda: _DatagramProtocol(self.__handle_datagram),
+                    local_addr=(host, datagram_port))
+        if probe_port is not None:
+            # Answers the latency probes of nodes choosing a server
+            self.__probe_transport, _ = \
+                await asyncio.get_event_loop().create_datagram_endpoint(
+                    multicast.LatencyProbeResponder,
+                    local_addr=(host, probe_port))
+        if self.__reload_interval is not None:
+            Config.add_configuration_changed_callback(
+                self.__configuration_changed)
+            self.__reload_task = asyncio.ensure_future(
+                self.__reload_configuration())
+
+    def close(self):
+        if self.__reload_task is not None:
+            self.__reload_task.cancel()
+            Config.remove_configuration_changed_callback(
+                self.__configuration_changed)
+        for connection in self.__connections.values():
+            self.__send(connection, DisconnectPacket())
+            connection.writer.close()
+        self.__server.close()
+        if self.__datagram_transport is not None:
+            self.__datagram_transport.close()
+        if self.__probe_transport is not None:
+            self.__probe_transport.close()
+
+    def wait_for_packet(self, number: int):
+        # Resolves once the number-th packet since the start has arrived
+        waiter = asyncio.get_event_loop().create_future()
+        if self.packets_received >= number:
+            waiter.set_result(None)
+        else:
+            self.__packet_waiters[number] = waiter
+        return waiter
+
+    async def __reload_configuration(self):
+        while True:
+            await asyncio.sleep(self.__reload_interval)
+            Config.reload_if_changed()
+
+    def __configuration_changed(self):
+        # Pushed without node ids, so that the nodes keep theirs and only
+        # take the new activity control parameters
+        for connection in self.__connections.values():
+            self.__send(connection, ConfigurationPacketToClient(
+                None, self.__send_image, self.__image_type,
+                protocol_version=self.__protocol_version,
+                server_time=time.time()))
+
+    def __send(self, connection: _Connection, packet: object):
+        connection.writer.writelines(
+            protocol.encode(packet, self.__protocol_version))
+        self.packets_sent += 1
+
+    def __packet_arrived(self, size: int):
+        self.bytes_received += size
+        self.packets_received += 1
+        waiter = self.__packet_waiters.pop(self.packets_received, None)
+        if waiter is not None:
+            waiter.set_result(None)
+
+    async def __handle_connection(self, reader, writer):
+        connection = _Connection(self.__next_node_id, writer)
+        self.__next_node_id += 1
+        self.__connections[connection.node_id] = connection
+
+        self.__send(connection, ConfigurationPacketToClient(
+            connection.node_id, self.__send_image, self.__image_type,
+            protocol_version=self.__protocol_version,
+            server_time=time.time()))
+        try:
+            while True:
+                encoded_length = await reader.readexactly(
+                    protocol.LENGTH_SIZE)
+                payload = await reader.readexactly(
+                    protocol.decode_length(encoded_length))
+                packet = protocol.decode(payload, allow_legacy=True)
+
+                connection.answer_by_datagram = False
+                self.__router.route_packet(connection, packet)
+                await writer.drain()
+                self.__packet_arrived(len(encoded_length) + len(payload))
+        except (asyncio.IncompleteReadError, ConnectionResetError,
+                BrokenPipeError):
+            logging.debug('Node %d disconnected', connection.node_id)
+        except protocol.ProtocolError as e:
+            logging.error('Protocol error from node %d: %s',
+                          connection.node_id, e)
+        finally:
+            self.__connections.pop(connection.node_id, None)
+            writer.close()
+
+    def __process_configuration_packet(self, connection: _Connection,
+                                       packet):
+        if packet.node_id == connection.node_id:
+            return
+        if packet.node_id in self.__connections:
+            logging.warning('Node id %d is already in use, keeping %d',
+                            packet.node_id, connection.node_id)
+        else:
+            # Hostname based ids override the one assigned on connection
+            del self.__connections[connection.node_id]
+            connection.node_id = packet.node_id
+            self.__connections[connection.node_id] = connection
+
+    def __handle_datagram(self, data: bytes, address: tuple):
+        try:
+            node_id, sequence, packet = protocol.decode_datagram(data)
+        except protocol.ProtocolError as e:
+            logging.warning('Invalid datagram from %s: %s', address, e)
+            return
+
+        connection = self.__connections.get(node_id)
+        if connection is None:
+            logging.warning('Datagram from unknown node %d', node_id)
+            return
+        if connection.last_received_sequence is not None and \
+                not protocol.is_newer_sequence(
+                    sequence, connection.last_received_sequence):
+            self.stale_datagrams += 1
+            return
+
+        connection.last_received_sequence = sequence
+        connection.datagram_address = address
+        connection.answer_by_datagram = True
+        self.datagrams_received += 1
+        self.__router.route_packet(connection, packet)
+        self.__packet_arrived(len(data))
+
+    def __answer(self, connection: _Connection, packet: object):
+        if not connection.answer_by_datagram:
+            self.__send(connection, packet)
+            return
+
+        connection.datagram_sequence = protocol.next_sequence(
+            connection.datagram_sequence)
+        self.__datagram_transport.sendto(
+            protocol.encode_datagram(packet, connection.node_id,
+                                     connection.datagram_sequence),
+            connection.datagram_address)
+        self.packets_sent += 1
+
+    def __process_data_packet(self, connection: _Connection, packet):
+        # Older clients do not send the frame fields
+        frame_sequence = getattr(packet, 'frame_sequence', None)
+        if frame_sequence is not None:
+            if connection.last_frame_sequence is not None and \
+                    frame_sequence <= connection.last_frame_sequence:
+                # An activation older than the one already known
+                self.stale_frames += 1
+                return
+            connection.last_frame_sequence = frame_sequence
+            connection.capture_latency = time.time() - packet.capture_time
+            self.capture_latencies.append(connection.capture_latency)
+
+        connection.activation_level = packet.activation_level
+        dependencies = self.__dependencies if self.__dependencies is not None \
+            else Config['dependencies']
+        activation_neighbours = 0.0
+        for neighbour_id, dependency in enumerate(
+                dependencies.get(connection.node_id, ()), 1):
+            neighbour = self.__connections.get(neighbour_id)
+            if dependency and neighbour is not None \
+                    and neighbour is not connection:
+                activation_neighbours += \
+                    dependency * neighbour.activation_level
+        self.__answer(connection, DataPacketToClient(activation_neighbours))
@@ -1,6 +1,18 @@
+import functools
 import math
 
-from vsn_client.common.utility import GainSampletimeTuple
+import numpy as np
+
+from vsn_client.common.utility import Config, GainSampletimeTuple
+
+TIME_CONSTANT = 0.7
+
+
+# Sample times take only a few distinct values, so the exponential is
+# computed once per value
+@functools.lru_cache(maxsize=None)
+def _decay_factor(sample_time: float) -> float:
+    return pow(math.e, -1.0 * (sample_time / TIME_CONSTANT))
 
 
 class VSNActivityController:
@@ -23,11 +35,9 @@ class VSNActivityController:
     # lowpass filter function modelled after a 1st order inertial object
     # transformed using delta minus method
     def __lowpass(self, prev_state, input_data, gain):
-        time_constant = 0.7
         output = \
-            (gain / time_constant) * input_data + \
-            prev_state * pow(math.e, -1.0 *
-                             (self.__parameters.sample_time / time_constant))
+            (gain / TIME_CONSTANT) * input_data + \
+            prev_state * _decay_factor(self.__parameters.sample_time)
         return output
 
     def set_params(self,
@@ -91,3 +101,155 @@ class VSNActivityController:
             self.__parameters = self.__parameters_below_threshold
         else:
             self.__parameters = self.__parameters_above_threshold
+
+
+class SparseDependencies:
+    # Dependency matrix in coordinate form, for networks where each node
+    # depends on a few neighbours only. Products are accumulated in the
+    # order of the entries.
+    def __init__(self, rows, columns, values, node_count: int):
+        self.__rows = np.asarray(rows, dtype=np.intp)
+        self.__columns = np.asarray(columns, dtype=np.intp)
+        self.__values = np.asarray(values, dtype=np.float64)
+        self.__node_count = node_count
+
+    @property
+    def shape(self) -> tuple:
+        return self.__node_count, self.__node_count
+
+    def dot(self, vector):
+        return np.bincount(self.__rows,
+                           weights=self.__values * vector[self.__columns],
+                           minlength=self.__node_count)
+
+
+def dependency_matrix(node_count: int, sparse: bool=False,
+                      dependencies: dict=None):
+    # Row n - 1 holds the dependencies of node n on its neighbours, missing
+    # nodes do not depend on anything
+    if dependencies is None:
+        dependencies = Config['dependencies']
+
+    entries = [(camera_id - 1, neighbour_index, value)
+               for camera_id, values in dependencies.items()
+               if 0 < camera_id <= node_count
+               for neighbour_index, value in enumerate(values[:node_count])
+               if value]
+
+    if sparse:
+        rows, columns, values = zip(*entries) if entries else ((), (), ())
+        return SparseDependencies(rows, columns, values, node_count)
+
+    matrix = np.zeros((node_count, node_count))
+    for row, column, value in entries:
+        matrix[row, column] = value
+    return matrix
+
+
+class VSNBatchActivityController:
+    # The activity control of many nodes at once, e.g. for simulations or a
+    # server mirroring the node states. Node i of the arrays follows exactly
+    # the same arithmetic as a VSNActivityController fed the same inputs.
+    def __init__(self, node_count: int, parameters_below_threshold,
+                 parameters_above_threshold, activation_level_threshold,
+                 dependencies=None):
+        self.__parameters_below_threshold = \
+            GainSampletimeTuple(parameters_below_threshold['gain'],
+                                parameters_below_threshold['sample_time'])
+        self.__parameters_above_threshold = \
+            GainSampletimeTuple(parameters_above_threshold['gain'],
+                                parameters_above_threshold['sample_time'])
+        self.__activation_level_threshold = activation_level_threshold
+        # Dense array or anything with a dot method, e.g. SparseDependencies.
+        # When given, the neighbour activations are computed from the
+        # activation levels before every update.
+        self.__dependencies = dependencies
+
+        self.__percentage_of_active_pixels = np.zeros(node_count)
+        self.__activation_level = np.zeros(node_count)
+        self.__activation_level_d = np.zeros(node_count)
+        self.__activation_neighbours = np.zeros(node_count)
+        # 0 for the parameters below the threshold, 1 for those above
+        self.__regime = np.zeros(node_count, dtype=np.intp)
+        self.__update_tables()
+
+    def __update_tables(self):
+        parameters = (self.__parameters_below_threshold,
+                      self.__parameters_above_threshold)
+        self.__gains = np.array([p.gain for p in parameters])
+        self.__sample_times = np.array([p.sample_time for p in parameters])
+        self.__scaled_gains = np.array([p.gain / TIME_CONSTANT
+                                        for p in parameters])
+        self.__decay_factors = np.array([_decay_factor(p.sample_time)
+                                         for p in parameters])
+
+    def set_params(self,
+                   activation_neighbours=None,
+                   activation_level_threshold=None,
+                   parameters_below_threshold=None,
+                   parameters_above_threshold=None):
+        if activation_neighbours is not None:
+            self.__activation_neighbours[:] = activation_neighbours
+        if activation_level_threshold is not None:
+            self.__activation_level_threshold = activation_level_threshold
+        if parameters_below_threshold is not None:
+            self.__parameters_below_threshold = parameters_below_threshold
+        if parameters_above_threshold is not None:
+            self.__parameters_above_threshold = parameters_above_threshold
+        self.__update_tables()
+
+    @property
+    def node_count(self) -> int:
+        return len(self.__activation_level)
+
+    @property
+    def sample_time(self):
+        return self.__sample_times[self.__regime]
+
+    @property
+    def gain(self):
+        return self.__gains[self.__regime]
+
+    @property
+    def percentage_of_active_pixels(self):
+        return self.__percentage_of_active_pixels
+
+    @property
+    def activation_level(self):
+        return self.__activation_level
+
+    @property
+    def activation_neighbours(self):
+        return self.__activation_neighbours
+
+    @property
+    def activation_is_below_threshold(self):
+        return self.__regime == 0
+
+    def update_sensor_state(self, percentage_of_active_pixels, nodes=None):
+        # Updates all the nodes, or only those selected by an index or mask
+        if self.__dependencies is not None:
+            self.__activation_neighbours[:] = \
+                self.__dependencies.dot(self.__activation_level)
+
+        if nodes is None:
+            nodes = slice(None)
+        self.__percentage_of_active_pixels[nodes] = percentage_of_active_pixels
+
+        regime = self.__regime[nodes]
+        decay_factors = self.__decay_factors[regime]
+
+        activation_level_d = \
+            self.__scaled_gains[regime] * (
+                self.__percentage_of_active_pixels[nodes] +
+                self.__activation_neighbours[nodes]) + \
+            self.__activation_level_d[nodes] * decay_factors
+        self.__activation_level_d[nodes] = activation_level_d
+
+        activation_level = \
+            (1.0 / TIME_CONSTANT) * activation_level_d + \
+            self.__activation_level[nodes] * decay_factors
+        self.__activation_level[nodes] = activation_level
+
+        self.__regime[nodes] = \
+            ~(activation_level < self.__activation_level_threshold)
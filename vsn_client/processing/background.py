@@ -0,0 +1,181 @@
+from abc import ABCMeta, abstractmethod
+
+import cv2
+import numpy as np
+
+
+# A background model compares grayscale frames with the background it keeps
+# and learns every frame into it. apply returns the mask of the pixels
+# differing from the background, 255 where they do, written into dst when
+# given. Noise removal by morphology is left to the image processor.
+class BackgroundModel(metaclass=ABCMeta):
+    @abstractmethod
+    def apply(self, foreground, dst=None):
+        ...
+
+    # True only if apply would return an empty mask for the frame, within
+    # the given mask and comparing only every row_step-th row and the last
+    # one. Models without a cheap way to tell always report a change.
+    def is_unchanged(self, foreground, mask=None, row_step: int=1) -> bool:
+        return False
+
+    # Learns the frame without computing its mask
+    def update(self, foreground):
+        self.apply(foreground)
+
+    @property
+    @abstractmethod
+    def background_image(self):
+        ...
+
+
+def _within_threshold(background, foreground, threshold: int, mask,
+                      row_step: int) -> bool:
+    # Views skipping rows are passed to OpenCV without copying
+    rows = slice(None, None, row_step)
+    if cv2.norm(background[rows], foreground[rows], cv2.NORM_INF,
+                mask=mask[rows] if mask is not None else None) > threshold:
+        return False
+    if (len(foreground) - 1) % row_step == 0:
+        return True
+    return cv2.norm(background[-1:], foreground[-1:], cv2.NORM_INF,
+                    mask=mask[-1:] if mask is not None else None) <= threshold
+
+
+class ApproximateMedianModel(BackgroundModel):
+    # The background moves by one grey level per frame towards the frame,
+    # converging to the median of the recent frames. Cheapest, but any
+    # change of lighting shows as activity until the background caught up.
+    def __init__(self, initial_image, threshold: int=6):
+        self.__background_image = initial_image.copy()
+        self.__threshold = threshold
+        self.__scratch_images = (np.empty_like(initial_image),
+                                 np.empty_like(initial_image))
+
+    @property
+    def background_image(self):
+        return self.__background_image
+
+    def apply(self, foreground, dst=None):
+        first, second = self.__scratch_images
+        background = self.__background_image
+
+        cv2.absdiff(background, foreground, dst=first)
+        cv2.medianBlur(first, 3, dst=second)
+        dst = cv2.compare(second, self.__threshold, cv2.CMP_GT, dst=dst)
+
+        self.update(foreground)
+        return dst
+
+    def is_unchanged(self, foreground, mask=None, row_step: int=1) -> bool:
+        # The median of differences within the threshold stays within it
+        return _within_threshold(self.__background_image, foreground,
+                                 self.__threshold, mask, row_step)
+
+    def update(self, foreground):
+        first = self.__scratch_images[0]
+        background = self.__background_image
+
+        # move the background one step towards the frame, i.e. clamp the
+        # frame to [background - 1, background + 1] with saturation
+        cv2.add(background, 1, dst=first)
+        cv2.min(foreground, first, dst=first)
+        cv2.subtract(background, 1, dst=background)
+        cv2.max(first, background, dst=background)
+
+
+class RunningAverageModel(BackgroundModel):
+    # Exponentially weighted average of the frames. The learning rate is the
+    # weight of each new frame, higher rates follow lighting changes faster
+    # and absorb stopping objects sooner.
+    def __init__(self, initial_image, learning_rate: float=0.05,
+                 threshold: int=6):
+        self.__average = initial_image.astype(np.float32)
+        self.__background_image = initial_image.copy()
+        self.__learning_rate = learning_rate
+        self.__threshold = threshold
+        self.__scratch_images = (np.empty_like(initial_image),
+                                 np.empty_like(initial_image))
+
+    @property
+    def background_image(self):
+        return self.__background_image
+
+    def apply(self, foreground, dst=None):
+        first, second = self.__scratch_images
+
+        cv2.absdiff(self.__background_image, foreground, dst=first)
+        cv2.medianBlur(first, 3, dst=second)
+        dst = cv2.compare(second, self.__threshold, cv2.CMP_GT, dst=dst)
+
+        self.update(foreground)
+        return dst
+
+    def is_unchanged(self, foreground, mask=None, row_step: int=1) -> bool:
+        return _within_threshold(self.__background_image, foreground,
+                                 self.__threshold, mask, row_step)
+
+    def update(self, foreground):
+        cv2.accumulateWeighted(foreground, self.__average,
+                               self.__learning_rate)
+        cv2.convertScaleAbs(self.__average, dst=self.__background_image)
+
+
+class _OpenCVSubtractorModel(BackgroundModel):
+    # Per pixel mixtures (MOG2) or nearest neighbours (KNN) of the recent
+    # values, robust to gradual lighting changes and flicker but several
+    # times more expensive. Shadows, if detected, are not counted as
+    # activity.
+    def __init__(self, subtractor, initial_image, learning_rate: float):
+        self.__subtractor = subtractor
+        self.__learning_rate = learning_rate
+        self.__mask = np.empty_like(initial_image)
+        self.__subtractor.apply(initial_image, self.__mask, 1.0)
+
+    @property
+    def background_image(self):
+        return self.__subtractor.getBackgroundImage()
+
+    def apply(self, foreground, dst=None):
+        self.__subtractor.apply(foreground, self.__mask,
+                                self.__learning_rate)
+        # Shadows are marked with 127
+        return cv2.compare(self.__mask, 127, cv2.CMP_GT, dst=dst)
+
+
+class MOG2Model(_OpenCVSubtractorModel):
+    # A negative learning rate lets OpenCV derive it from the history
+    def __init__(self, initial_image, history: int=500,
+                 variance_threshold: float=16, detect_shadows: bool=False,
+                 learning_rate: float=-1):
+        super().__init__(
+            cv2.createBackgroundSubtractorMOG2(history, variance_threshold,
+                                               detect_shadows),
+            initial_image, learning_rate)
+
+
+class KNNModel(_OpenCVSubtractorModel):
+    def __init__(self, initial_image, history: int=500,
+                 distance_threshold: float=400, detect_shadows: bool=False,
+                 learning_rate: float=-1):
+        super().__init__(
+            cv2.createBackgroundSubtractorKNN(history, distance_threshold,
+                                              detect_shadows),
+            initial_image, learning_rate)
+
+
+BACKGROUND_MODELS = {
+    'approximate_median': ApproximateMedianModel,
+    'running_average': RunningAverageModel,
+    'mog2': MOG2Model,
+    'knn': KNNModel
+}
+
+
+def create_background_model(name: str, initial_image,
+                            parameters: dict=None) -> BackgroundModel:
+    try:
+        model = BACKGROUND_MODELS[name]
+    except KeyError:
+        raise ValueError('Unsupported background model: %r' % name)
+    return model(initial_image, **(parameters or {}))
@@ -1,23 +1,145 @@
+import math
+
 import cv2
 import numpy as np
 
-from vsn_client.common.utility import ImageType
+from vsn_client.common import metrics
+from vsn_client.common.utility import Frame, ImageType
+from vsn_client.processing.background import create_background_model
+
+JPEG_ENCODE_PARAMETERS = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
+
+
+def encode_image(image, encode_parameters: list=JPEG_ENCODE_PARAMETERS):
+    result, image_encoded = cv2.imencode('.jpg', image, encode_parameters)
+    # Flat view of the encoder output, handed over to the socket as is
+    return memoryview(image_encoded).cast('B')
 
 
 class VSNImageProcessor:
-    def __init__(self, initial_frame):
-        self.__background_image = cv2.cvtColor(initial_frame,
-                                               cv2.COLOR_BGR2GRAY)
-        self.__foreground_image = self.__background_image
-        self.__difference_thresholded_image = self.__background_image
-        self.__structing_element = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,
-                                                             (3, 3))
+    def __init__(self, initial_frame, preallocate: bool=False,
+                 excluded_regions: list=None, tile_grid: tuple=None,
+                 detection_scale: float=1.0,
+                 background_model: str='approximate_median',
+                 background_parameters: dict=None,
+                 morphology_kernel_size: int=3,
+                 stable_update_interval: int=None):
+        # Detection may run on a downscaled copy of each frame, while the
+        # foreground image stays available in full resolution
+        self.__detection_size = None
+        self.__full_resolution_foreground_image = None
+        if detection_scale != 1.0:
+            frame_height, frame_width = initial_frame.shape[:2]
+            self.__detection_size = (
+                max(int(round(frame_width * detection_scale)), 1),
+                max(int(round(frame_height * detection_scale)), 1)
+            )
+
+        initial_image = self.__convert_to_gray(initial_frame)
+        self.__background_model = create_background_model(
+            background_model, initial_image, background_parameters)
+        self.__frame = None
+        self.__foreground_image = initial_image
+        self.__difference_thresholded_image = np.zeros_like(initial_image)
+        self.__structing_element = cv2.getStructuringElement(
+            cv2.MORPH_ELLIPSE, (morphology_kernel_size,) * 2)
+        self.__processed_frames = metrics.registry.counter(
+            'vsn_processed_frames_total', 'Frames run through the detection')
+        self.__active_pixels = metrics.registry.gauge(
+            'vsn_active_pixels_percentage',
+            'Percentage of active pixels in the last frame')
+
+        # Frames of a stable scene, not differing from the background by more
+        # than its threshold anywhere, skip the blur, threshold and
+        # morphology, and the background learns only every n-th of them.
+        # None processes every frame in full.
+        self.__stable_update_interval = stable_update_interval
+        self.__stable_frames = 0
+        self.__skipped_frames = metrics.registry.counter(
+            'vsn_stable_frames_skipped_total',
+            'Frames of a stable scene not run through the detection')
+
+        height, width = initial_image.shape
+        self.__region_of_interest = None
+        region_of_interest = np.full((height, width), 255, np.uint8)
+        if excluded_regions:
+            for x, y, region_width, region_height in excluded_regions:
+                # Regions are given in full resolution coordinates
+                region_of_interest[
+                    int(y * detection_scale):
+                    int(math.ceil((y + region_height) * detection_scale)),
+                    int(x * detection_scale):
+                    int(math.ceil((x + region_width) * detection_scale))
+                ] = 0
+            self.__region_of_interest = region_of_interest
+        self.__area_of_interest = max(cv2.countNonZero(region_of_interest), 1)
+
+        # Differences next to an excluded region still spread into the
+        # region of interest through the median blur and the morphology, so
+        # the stable scene check looks that far into the excluded regions
+        self.__stable_check_mask = None
+        if self.__region_of_interest is not None:
+            margin = 1 + 2 * (morphology_kernel_size // 2)
+            self.__stable_check_mask = cv2.dilate(
+                region_of_interest, cv2.getStructuringElement(
+                    cv2.MORPH_RECT, (2 * margin + 1,) * 2))
+        # Active pixels need at least five of the nine differences around
+        # them above the threshold, and an opening keeps them only with
+        # their neighbours above and below. With a kernel of three or more
+        # two of those differences lie in even rows or the last one, so
+        # comparing only those rows finds every frame with active pixels.
+        self.__stable_check_row_step = 2 if morphology_kernel_size >= 3 \
+            else 1
+
+        self.__tile_edges = None
+        self.__tile_scales = None
+        self.__percentage_of_active_pixels_in_tiles = None
+        if tile_grid:
+            rows, columns = tile_grid
+            self.__tile_edges = (
+                np.linspace(0, height, rows + 1).astype(np.intp)[:-1],
+                np.linspace(0, width, columns + 1).astype(np.intp)[:-1]
+            )
+            # Mask values are 255, so the scale folds in the division by the
+            # number of pixels inside the region of interest of each tile
+            tile_areas = self.__sum_tiles(region_of_interest)
+            self.__tile_scales = np.divide(
+                100.0, tile_areas, out=np.zeros(tile_areas.shape),
+                where=tile_areas > 0
+            )
+            self.__percentage_of_active_pixels_in_tiles = \
+                np.zeros(tile_areas.shape)
+
+        if preallocate:
+            # All intermediate images are allocated once, with the size of
+            # the frames delivered by the camera, and overwritten in place
+            self.__foreground_image = np.empty_like(initial_image)
+            self.__scratch_images = (np.empty_like(initial_image),
+                                     np.empty_like(initial_image))
+            self.get_percentage_of_active_pixels_in_frame = \
+                self.__get_percentage_of_active_pixels_in_frame_in_place
+
+    @property
+    def percentage_of_active_pixels_in_tiles(self):
+        return self.__percentage_of_active_pixels_in_tiles
+
+    @property
+    def frame(self) -> Frame:
+        # The frame processed last by process_frame
+        return self.__frame
+
+    def process_frame(self, frame: Frame) -> float:
+        self.__frame = frame
+        return self.get_percentage_of_active_pixels_in_frame(frame.image)
 
     def get_image(self, image_type: ImageType):
         if image_type == ImageType.foreground:
-            image = self.__foreground_image
+            if self.__detection_size is None:
+                image = self.__foreground_image
+            else:
+                image = self.__full_resolution_foreground_image
         elif image_type == ImageType.background:
-            image = self.__background_image
+            image = self.__background_model.background_image
         else:
             image = self.__difference_thresholded_image
 
@@ -25,39 +147,94 @@ class VSNImageProcessor:
 
     def get_percentage_of_active_pixels_in_frame(self, frame):
         # process the frame
-        self.__foreground_image = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-        # calculate the difference between current and background frame
-        difference = cv2.absdiff(self.__background_image,
-                                 self.__foreground_image)
+        self.__foreground_image = self.__convert_to_gray(frame)
 
-        # process the difference
-        # use median blur
-        blurred = cv2.medianBlur(difference, 3)
+        if self.__is_stable(self.__foreground_image):
+            self.__difference_thresholded_image = \
+                np.zeros_like(self.__foreground_image)
+            return self.__count_no_active_pixels()
 
-        # do the thresholding
-        thresholded = cv2.compare(blurred, 6, cv2.CMP_GT)
+        # compare with the background, which learns the frame
+        mask = self.__background_model.apply(self.__foreground_image)
 
         # erode and dilate
-        eroded = cv2.erode(thresholded, self.__structing_element)
+        eroded = cv2.erode(mask, self.__structing_element)
         dilated = cv2.dilate(eroded, self.__structing_element)
 
         # store the difference image for further usage
         self.__difference_thresholded_image = dilated
 
-        # count non zero elements
-        nonzero_pixels = cv2.countNonZero(dilated)
-
-        # calculate the number of non-zero pixels
-        height, width = self.__foreground_image.shape
-        percentage_of_nonzero_pixels = (nonzero_pixels * 100 / (height * width))
-
-        # prepare data for background update
-        mask_gt = np.greater(self.__background_image, self.__foreground_image)
-        mask_lt = np.less(self.__background_image, self.__foreground_image)
-
-        # update the background
-        self.__background_image += mask_lt
-        self.__background_image -= mask_gt
-
-        return percentage_of_nonzero_pixels
+        # calculate the percentage of non-zero pixels
+        return self.__count_active_pixels(dilated)
+
+    def __get_percentage_of_active_pixels_in_frame_in_place(self, frame):
+        first, second = self.__scratch_images
+        foreground = self.__foreground_image
+
+        self.__convert_to_gray(frame, dst=foreground)
+        if self.__is_stable(foreground):
+            self.__difference_thresholded_image.fill(0)
+            return self.__count_no_active_pixels()
+
+        self.__background_model.apply(foreground, dst=first)
+        cv2.erode(first, self.__structing_element, dst=second)
+        cv2.dilate(second, self.__structing_element,
+                   dst=self.__difference_thresholded_image)
+
+        return self.__count_active_pixels(
+            self.__difference_thresholded_image)
+
+    def __convert_to_gray(self, frame, dst=None):
+        if self.__detection_size is None:
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=dst)
+
+        # The full resolution buffer is allocated by the first conversion
+        self.__full_resolution_foreground_image = cv2.cvtColor(
+            frame, cv2.COLOR_BGR2GRAY,
+            dst=self.__full_resolution_foreground_image)
+        return cv2.resize(self.__full_resolution_foreground_image,
+                          self.__detection_size, dst=dst,
+                          interpolation=cv2.INTER_AREA)
+
+    def __sum_tiles(self, mask):
+        row_edges, column_edges = self.__tile_edges
+        return np.add.reduceat(
+            np.add.reduceat(mask, row_edges, axis=0, dtype=np.uint32),
+            column_edges, axis=1
+        )
+
+    def __is_stable(self, foreground) -> bool:
+        if self.__stable_update_interval is None or \
+                not self.__background_model.is_unchanged(
+                    foreground, self.__stable_check_mask,
+                    self.__stable_check_row_step):
+            self.__stable_frames = 0
+            return False
+
+        self.__stable_frames += 1
+        if self.__stable_frames % self.__stable_update_interval == 0:
+            self.__background_model.update(foreground)
+        return True
+
+    def __count_no_active_pixels(self):
+        # Same outcome as counting the empty mask of a stable frame
+        if self.__percentage_of_active_pixels_in_tiles is not None:
+            self.__percentage_of_active_pixels_in_tiles.fill(0.0)
+        self.__processed_frames.inc()
+        self.__skipped_frames.inc()
+        self.__active_pixels.set(0.0)
+        return 0.0
+
+    def __count_active_pixels(self, mask):
+        if self.__region_of_interest is not None:
+            cv2.bitwise_and(mask, self.__region_of_interest, dst=mask)
+
+        if self.__tile_edges is not None:
+            np.multiply(self.__sum_tiles(mask), self.__tile_scales,
+                        out=self.__percentage_of_active_pixels_in_tiles)
+
+        percentage_of_active_pixels = \
+            cv2.countNonZero(mask) * 100 / self.__area_of_interest
+        self.__processed_frames.inc()
+        self.__active_pixels.set(percentage_of_active_pixels)
+        return percentage_of_active_pixels
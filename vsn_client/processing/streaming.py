@@ -0,0 +1,178 @@
+import cv2
+import numpy as np
+
+from vsn_client.common import metrics
+from vsn_client.processing.image import encode_image
+
+
+class VSNAdaptiveImageSender:
+    def __init__(self, bandwidth_budget: float=None, min_quality: int=30,
+                 max_quality: int=90, quality_step: int=10,
+                 scales: tuple=(1.0, 0.75, 0.5), skip_threshold: float=0.1,
+                 keyframe_interval: int=10, keyframe_max_age: float=60.0,
+                 max_regions: int=4, region_padding: int=8,
+                 max_region_area: float=0.5, change_threshold: int=6):
+        self.__bandwidth_budget = bandwidth_budget
+        self.__min_quality = min_quality
+        self.__max_quality = max_quality
+        self.__quality_step = quality_step
+        self.__scales = scales
+        self.__skip_threshold = skip_threshold
+        self.__keyframe_interval = keyframe_interval
+        self.__keyframe_max_age = keyframe_max_age
+        self.__max_regions = max_regions
+        self.__region_padding = region_padding
+        self.__max_region_area = max_region_area
+        self.__change_threshold = change_threshold
+
+        self.__quality = max_quality
+        self.__scale_index = 0
+        # Grayscale copy of the image as the server shows it, i.e. the last
+        # keyframe with the patches sent since pasted onto it. Changes are
+        # found against it rather than against the background, so that
+        # whatever left the scene since is sent as well.
+        self.__sent_image = None
+        self.__difference_images = None
+        # Skipped images and the time spent skipping them count too, so a
+        # keyframe is sent at least every keyframe_interval images or
+        # keyframe_max_age seconds
+        self.__images_since_keyframe = 0
+        self.__time_since_keyframe = 0.0
+
+        self.__skipped_images = metrics.registry.counter(
+            'vsn_skipped_images_total',
+            'Images not sent because the scene did not change')
+        self.__keyframes = metrics.registry.counter(
+            'vsn_keyframes_total', 'Whole images sent')
+        self.__partial_images = metrics.registry.counter(
+            'vsn_partial_images_total', 'Images sent as changed regions only')
+        self.__image_bytes = metrics.registry.counter(
+            'vsn_image_bytes_total', 'Bytes of encoded images')
+        self.__quality_gauge = metrics.registry.gauge(
+            'vsn_image_quality', 'Current JPEG quality')
+        self.__scale_gauge = metrics.registry.gauge(
+            'vsn_image_scale', 'Current scale of the images sent')
+        self.__quality_gauge.set(self.__quality)
+        self.__scale_gauge.set(self.__scales[self.__scale_index])
+
+    @property
+    def quality(self) -> int:
+        return self.__quality
+
+    @property
+    def scale(self) -> float:
+        return self.__scales[self.__scale_index]
+
+    def __adapt(self, encoded_bytes: int, interval: float):
+        if self.__bandwidth_budget is None or interval <= 0:
+            return
+
+        rate = encoded_bytes / interval
+        if rate > self.__bandwidth_budget:
+            # Lower the quality first, then the resolution
+            if self.__quality > self.__min_quality:
+                self.__quality = max(self.__quality - self.__quality_step,
+                                     self.__min_quality)
+            elif self.__scale_index < len(self.__scales) - 1:
+                self.__scale_index += 1
+        elif rate < self.__bandwidth_budget / 2:
+            # Restore in the reverse order
+            if self.__scale_index > 0:
+                self.__scale_index -= 1
+            elif self.__quality < self.__max_quality:
+                self.__quality = min(self.__quality + self.__quality_step,
+                                     self.__max_quality)
+
+        self.__quality_gauge.set(self.__quality)
+        self.__scale_gauge.set(self.__scales[self.__scale_index])
+
+    def __difference_mask(self, gray_image):
+        # Same noise suppression as the background models
+        first, second = self.__difference_images
+        cv2.absdiff(gray_image, self.__sent_image, dst=first)
+        cv2.medianBlur(first, 3, dst=second)
+        return cv2.compare(second, self.__change_threshold, cv2.CMP_GT,
+                           dst=first)
+
+    def __changed_regions(self, difference_mask):
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(
+            difference_mask)
+        # Label 0 is the background, keep the largest regions
+        stats = sorted(stats[1:], key=lambda s: s[cv2.CC_STAT_AREA],
+                       reverse=True)[:self.__max_regions]
+
+        height, width = difference_mask.shape
+        padding = self.__region_padding
+        return [(max(int(x) - padding, 0), max(int(y) - padding, 0),
+                 min(int(x + region_width) + padding, width),
+                 min(int(y + region_height) + padding, height))
+                for x, y, region_width, region_height, area in stats]
+
+    # Returns the whole image to send, or the changed regions as a list of
+    # (x, y, encoded_image) patches onto the last whole image, or neither
+    # when the image did not change since the last one sent
+    def encode(self, image, interval: float):
+        scale = self.__scales[self.__scale_index]
+        if scale != 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale,
+                               interpolation=cv2.INTER_AREA)
+        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) \
+            if image.ndim == 3 else image
+
+        self.__time_since_keyframe += interval
+        keyframe_due = self.__sent_image is None or \
+            gray_image.shape != self.__sent_image.shape or \
+            self.__images_since_keyframe + 1 >= self.__keyframe_interval or \
+            self.__time_since_keyframe >= self.__keyframe_max_age
+
+        difference_mask = None
+        if not keyframe_due:
+            difference_mask = self.__difference_mask(gray_image)
+            changed = cv2.countNonZero(difference_mask) * 100 / \
+                difference_mask.size
+            if changed < self.__skip_threshold:
+                self.__images_since_keyframe += 1
+                self.__skipped_images.inc()
+                return None, None
+
+        encode_parameters = [int(cv2.IMWRITE_JPEG_QUALITY), self.__quality]
+
+        regions = None
+        if not keyframe_due:
+            regions = self.__changed_regions(difference_mask)
+            area = sum((right - left) * (bottom - top)
+                       for left, top, right, bottom in regions)
+            if area > self.__max_region_area * image.shape[0] * \
+                    image.shape[1]:
+                # Patches would cost about as much as the whole image
+                regions = None
+
+        if regions is None:
+            encoded_image = encode_image(image, encode_parameters)
+            encoded_bytes = encoded_image.nbytes
+            if keyframe_due:
+                self.__sent_image = gray_image.copy()
+                self.__difference_images = (np.empty_like(gray_image),
+                                            np.empty_like(gray_image))
+            else:
+                self.__sent_image[...] = gray_image
+            self.__images_since_keyframe = 0
+            self.__time_since_keyframe = 0.0
+            self.__keyframes.inc()
+            result = encoded_image, None
+        else:
+            encoded_regions = []
+            for left, top, right, bottom in regions:
+                encoded_regions.append((left, top, encode_image(
+                    image[top:bottom, left:right], encode_parameters)))
+                self.__sent_image[top:bottom, left:right] = \
+                    gray_image[top:bottom, left:right]
+            encoded_bytes = sum(region.nbytes
+                                for x, y, region in encoded_regions)
+            self.__images_since_keyframe += 1
+            self.__partial_images.inc()
+            result = None, encoded_regions
+
+        self.__image_bytes.inc(encoded_bytes)
+        self.__adapt(encoded_bytes, interval)
+        return result
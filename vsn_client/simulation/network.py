@@ -0,0 +1,135 @@
+import heapq
+import time
+
+import numpy as np
+
+from vsn_client.processing.activity import VSNActivityController
+
+
+def _events(trace, rate: float, event_threshold: float) -> list:
+    # (onset, end) times of the intervals with the trace above the threshold
+    active = np.concatenate(([False], trace >= event_threshold, [False]))
+    edges = np.flatnonzero(active[1:] != active[:-1])
+    return [(onset / rate, end / rate)
+            for onset, end in zip(edges[::2], edges[1::2])]
+
+
+def _summary(latencies: list) -> dict:
+    if not latencies:
+        return {'mean': None, 'p95': None, 'max': None}
+    return {'mean': float(np.mean(latencies)),
+            'p95': float(np.percentile(latencies, 95)),
+            'max': float(np.max(latencies))}
+
+
+class VSNNetworkSimulator:
+    # Discrete-event simulation of the activity control of a whole network.
+    # Every node samples its trace at its own, varying sample time and is
+    # coupled to the latest activation levels of its neighbours, as relayed
+    # by the server. Samples in the above-threshold regime count as images
+    # sent, as the reactor then attaches one to the data packet.
+    def __init__(self, traces, parameters_below_threshold,
+                 parameters_above_threshold, activation_level_threshold,
+                 dependencies: dict, event_threshold: float=5.0):
+        self.__traces = traces
+        self.__controller_arguments = (parameters_below_threshold,
+                                       parameters_above_threshold,
+                                       activation_level_threshold)
+        node_count = traces.values.shape[1]
+        # (neighbour index, dependency) pairs of every node, node ids are
+        # the column numbers counted from 1
+        self.__neighbours = [
+            [(neighbour, value) for neighbour, value in
+             enumerate(dependencies.get(node + 1, ())[:node_count]) if value]
+            for node in range(node_count)
+        ]
+        self.__events = [_events(traces.values[:, node], traces.rate,
+                                 event_threshold)
+                         for node in range(node_count)]
+
+    def run(self) -> dict:
+        values, rate = self.__traces
+        samples, node_count = values.shape
+        duration = samples / rate
+        controllers = [VSNActivityController(*self.__controller_arguments)
+                       for _ in range(node_count)]
+
+        frames_processed = [0] * node_count
+        images_sent = [0] * node_count
+        time_above_threshold = [0.0] * node_count
+        # Per node the first event not over yet and, per event, the times of
+        # the first sample seeing it and of the switch to the fast regime
+        next_event = [0] * node_count
+        detected_at = [[None] * len(events) for events in self.__events]
+        activated_at = [[None] * len(events) for events in self.__events]
+
+        wall_time_start = time.perf_counter()
+        queue = [(0.0, node) for node in range(node_count)]
+        # Strongly coupled neighbours may drive the activation levels to
+        # infinity, which is reported as a diverged run
+        with np.errstate(over='ignore', invalid='ignore'):
+            while queue:
+                sample_time, node = heapq.heappop(queue)
+                if sample_time >= duration:
+                    break
+
+                controller = controllers[node]
+                controller.set_params(activation_neighbours=sum(
+                    value * controllers[neighbour].activation_level
+                    for neighbour, value in self.__neighbours[node]))
+                controller.update_sensor_state(values[int(sample_time * rate),
+                                                      node])
+                frames_processed[node] += 1
+                above_threshold = not controller.activation_is_below_threshold
+                if above_threshold:
+                    images_sent[node] += 1
+                    time_above_threshold[node] += controller.sample_time
+
+                events = self.__events[node]
+                index = next_event[node]
+                while index < len(events) and events[index][0] <= sample_time:
+                    onset, end = events[index]
+                    if sample_time < end:
+                        if detected_at[node][index] is None:
+                            detected_at[node][index] = sample_time
+                        if above_threshold and \
+                                activated_at[node][index] is None:
+                            activated_at[node][index] = sample_time
+                        break
+                    index += 1
+                next_event[node] = index
+
+                heapq.heappush(queue, (sample_time + controller.sample_time,
+                                       node))
+        wall_time = time.perf_counter() - wall_time_start
+
+        detection_latencies, activation_latencies = [], []
+        missed_events = 0
+        for node, events in enumerate(self.__events):
+            for index, (onset, end) in enumerate(events):
+                if detected_at[node][index] is None:
+                    missed_events += 1
+                else:
+                    detection_latencies.append(
+                        detected_at[node][index] - onset)
+                if activated_at[node][index] is not None:
+                    activation_latencies.append(
+                        activated_at[node][index] - onset)
+
+        return {
+            'duration': duration,
+            'nodes': node_count,
+            'frames_processed': sum(frames_processed),
+            'images_sent': sum(images_sent),
+            'frames_per_node_hour':
+                sum(frames_processed) / node_count / duration * 3600,
+            'fast_regime_fraction':
+                sum(time_above_threshold) / node_count / duration,
+            'events': sum(len(events) for events in self.__events),
+            'missed_events': missed_events,
+            'detection_latency': _summary(detection_latencies),
+            'activation_latency': _summary(activation_latencies),
+            'diverged': not all(np.isfinite(controller.activation_level)
+                                for controller in controllers),
+            'realtime_factor': duration / wall_time
+        }
@@ -0,0 +1,132 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import sys
+
+from vsn_client.common.utility import Config
+from vsn_client.simulation.network import VSNNetworkSimulator
+from vsn_client.simulation.traces import load_traces, synthetic_traces
+
+SETTINGS = ('gain_below_threshold', 'sample_time_below_threshold',
+            'gain_above_threshold', 'sample_time_above_threshold',
+            'activation_level_threshold', 'dependency_scale')
+
+
+def _simulate(traces, settings: dict, dependencies: dict,
+              event_threshold: float) -> dict:
+    scale = settings['dependency_scale']
+    simulator = VSNNetworkSimulator(
+        traces,
+        {'gain': settings['gain_below_threshold'],
+         'sample_time': settings['sample_time_below_threshold']},
+        {'gain': settings['gain_above_threshold'],
+         'sample_time': settings['sample_time_above_threshold']},
+        settings['activation_level_threshold'],
+        {node: [value * scale for value in values]
+         for node, values in dependencies.items()},
+        event_threshold
+    )
+    result = simulator.run()
+    result['settings'] = settings
+    return result
+
+
+def _simulate_packed(arguments: tuple) -> dict:
+    return _simulate(*arguments)
+
+
+def sweep(traces, settings_grid: list, dependencies: dict,
+          event_threshold: float=5.0, processes: int=None) -> list:
+    # One simulation per settings dict, spread over the cores
+    arguments = [(traces, settings, dependencies, event_threshold)
+                 for settings in settings_grid]
+    if processes == 1:
+        return [_simulate_packed(a) for a in arguments]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(_simulate_packed, arguments)
+
+
+def main():
+    clients = Config['clients']
+    below, above = clients['parameters_below_threshold'], \
+        clients['parameters_above_threshold']
+
+    parser = argparse.ArgumentParser(
+        description='Simulate the activity control of the whole network on '
+                    'recorded or synthetic activity traces, for every '
+                    'combination of the given settings')
+    parser.add_argument('--traces', type=str, default=None,
+                        help='.npy or comma separated file with the '
+                             'percentage of active pixels, one column per '
+                             'camera (default: synthetic traces)')
+    parser.add_argument('--rate', type=float, default=20.0,
+                        help='samples per second of the traces '
+                             '(default: 20)')
+    parser.add_argument('--nodes', type=int, default=5,
+                        help='cameras of the synthetic traces (default: 5)')
+    parser.add_argument('--duration', type=float, default=3600.0,
+                        help='seconds of synthetic traces (default: 3600)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--event-threshold', dest='event_threshold',
+                        type=float, default=5.0,
+                        help='percentage of active pixels counted as an '
+                             'event to detect (default: 5)')
+    parser.add_argument('--gain-below', dest='gain_below_threshold',
+                        type=float, nargs='+', default=[below['gain']])
+    parser.add_argument('--sample-time-below',
+                        dest='sample_time_below_threshold', type=float,
+                        nargs='+', default=[below['sample_time']])
+    parser.add_argument('--gain-above', dest='gain_above_threshold',
+                        type=float, nargs='+', default=[above['gain']])
+    parser.add_argument('--sample-time-above',
+                        dest='sample_time_above_threshold', type=float,
+                        nargs='+', default=[above['sample_time']])
+    parser.add_argument('--threshold', dest='activation_level_threshold',
+                        type=float, nargs='+',
+                        default=[clients['activation_level_threshold']])
+    parser.add_argument('--dependency-scale', dest='dependency_scale',
+                        type=float, nargs='+', default=[1.0],
+                        help='factors applied to the whole dependency '
+                             'table (default: 1)')
+    parser.add_argument('-p', dest='processes', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('-o', dest='output', type=str, default=None,
+                        help='write all the results as JSON to a file')
+    args = parser.parse_args()
+
+    if args.traces:
+        traces = load_traces(args.traces, args.rate)
+    else:
+        traces = synthetic_traces(args.nodes, args.duration, args.rate,
+                                  seed=args.seed)
+
+    settings_grid = [dict(zip(SETTINGS, values)) for values in
+                     itertools.product(*(getattr(args, name)
+                                         for name in SETTINGS))]
+    results = sweep(traces, settings_grid, Config['dependencies'],
+                    args.event_threshold, args.processes)
+
+    print('%6s %6s %6s %6s %6s %6s %10s %8s %7s %9s %9s %8s %9s' % (
+        'g_bt', 'st_bt', 'g_at', 'st_at', 'thr', 'dep', 'frames/h',
+        'images', 'missed', 'det [s]', 'act [s]', 'x rt', 'diverged'))
+    for result in results:
+        settings = result['settings']
+        print('%6g %6g %6g %6g %6g %6g %10.0f %8d %7d %9s %9s %8.0f %9s' % (
+            tuple(settings[name] for name in SETTINGS) + (
+                result['frames_per_node_hour'], result['images_sent'],
+                result['missed_events'],
+                '%.3f' % result['detection_latency']['mean']
+                if result['detection_latency']['mean'] is not None else '-',
+                '%.3f' % result['activation_latency']['mean']
+                if result['activation_latency']['mean'] is not None else '-',
+                result['realtime_factor'], result['diverged'])))
+
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(results, stream, indent=2)
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Percentage of active pixels of every camera (columns) sampled at a fixed
+# rate (rows)
+Traces = namedtuple('Traces', ['values', 'rate'])
+
+
+def load_traces(path: str, rate: float) -> Traces:
+    # .npy arrays or text files with one column per camera
+    if path.endswith('.npy'):
+        values = np.load(path)
+    else:
+        values = np.loadtxt(path, delimiter=',', ndmin=2)
+    return Traces(np.asarray(values, dtype=np.float64), rate)
+
+
+def synthetic_traces(node_count: int, duration: float, rate: float=20.0,
+                     walkers_per_hour: float=30.0, dwell_time: float=4.0,
+                     transit_time: float=2.0, activity: float=20.0,
+                     noise: float=0.3, seed: int=0) -> Traces:
+    # People walking along a row of cameras, in view of each one for about
+    # dwell_time seconds and reaching the next one transit_time later
+    random = np.random.RandomState(seed)
+    samples = int(duration * rate)
+    values = random.exponential(noise, (samples, node_count))
+
+    walkers = random.poisson(walkers_per_hour * duration / 3600.0)
+    for start in random.uniform(0, duration, walkers):
+        cameras = range(node_count) if random.rand() < 0.5 \
+            else range(node_count - 1, -1, -1)
+        time = start
+        for camera in cameras:
+            in_view = random.uniform(0.5, 1.5) * dwell_time
+            first = int(time * rate)
+            last = min(int((time + in_view) * rate), samples)
+            if first >= samples:
+                break
+            values[first:last, camera] += \
+                random.uniform(0.5, 1.5) * activity
+            time += in_view + random.uniform(0.5, 1.5) * transit_time
+
+    return Traces(values, rate)